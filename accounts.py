@@ -0,0 +1,215 @@
+"""Runs many phemex accounts from one config file instead of one process each.
+
+Every account gets its own exchange client and request scheduler (so its own
+rate budget) and its own state directory under ACCOUNTS_STATE_DIR. Market
+metadata is loaded once per exchange kind (live phemex, or a mock with given
+options) and shared by the clients of that kind. Accounts run as threads;
+with "processes" above 1 they are split across that many worker processes,
+which read the market snapshot the parent wrote instead of downloading it.
+With STREAM_MODE=1 every account streams over its own websocket connection
+with its own credentials; mock accounts cannot stream and are refused.
+
+    python accounts.py [accounts.json]
+
+accounts.json:
+
+    {
+        "processes": 1,
+        "accounts": [
+            {"name": "main", "api_key_env": "API_KEY", "secret_env": "SECRET"},
+            {"name": "sub1", "api_key_env": "SUB1_API_KEY", "secret_env": "SUB1_SECRET"},
+            {"name": "paper", "exchange": "mock", "mock": {"n_positions": 50}}
+        ]
+    }
+"""
+import atexit
+import contextvars
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+import main
+
+ACCOUNTS_FILE = os.getenv('ACCOUNTS_FILE', 'accounts.json')
+ACCOUNTS_STATE_DIR = os.getenv('ACCOUNTS_STATE_DIR', 'accounts')
+
+# main.py globals that belong to a single account
+ACCOUNT_GLOBALS = [
+    'exchange', 'trailing_store', 'order_journal', 'balance_cache', 'position_modes', 'position_closes',
+    'active_universe', 'cadence', 'tick_stats', 'market_cache',
+]
+
+current_account = contextvars.ContextVar('current_account')
+
+
+class AccountGlobal:
+    """Stands in for one of main's per-account globals and forwards to the running account's object."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(getattr(current_account.get(), self.name), attr)
+
+
+def load_config(path=ACCOUNTS_FILE):
+    with open(path, "r") as f:
+        config = json.load(f)
+    names = [account['name'] for account in config['accounts']]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Account names must be unique: {names}")
+    return config
+
+
+def account_credentials(config):
+    return {
+        'apiKey': config.get('api_key') or os.getenv(config.get('api_key_env', '')),
+        'secret': config.get('secret') or os.getenv(config.get('secret_env', '')),
+    }
+
+
+def account_mock_options(config):
+    if config.get('exchange', main.EXCHANGE) != 'mock':
+        return None
+    return config.get('mock') or {'n_positions': main.MOCK_POSITIONS, 'latency': main.MOCK_LATENCY}
+
+
+class Account:
+    """One account's exchange client and state, which main's globals resolve to while it runs."""
+
+    def __init__(self, config, market_cache):
+        self.name = config['name']
+        self.state_dir = os.path.join(ACCOUNTS_STATE_DIR, self.name)
+        os.makedirs(self.state_dir, exist_ok=True)
+        mock_options = account_mock_options(config)
+        if main.STREAM_MODE and mock_options is not None:
+            raise ValueError(f"Account {self.name}: STREAM_MODE needs phemex websockets, not the mock exchange")
+        self.credentials = account_credentials(config)
+        self.exchange = main.create_exchange(mock_options, self.credentials)
+        self.market_cache = market_cache
+        market_cache.follow(self.exchange)
+        self.trailing_store = main.create_trailing_store(state_dir=self.state_dir)
+        self.order_journal = main.OrderJournal(os.path.join(self.state_dir, main.ORDER_JOURNAL_FILE))
+        self.balance_cache = main.BalanceCache(self.exchange)
+        self.position_modes = main.PositionModeCache(os.path.join(self.state_dir, main.POSITION_MODE_FILE))
+        self.position_closes = main.PositionCloseTracker()
+        self.active_universe = main.ActiveUniverse()
+        self.cadence = main.CadencePlanner(self.exchange)
+        self.tick_stats = main.TickStats()
+
+    def run(self):
+        current_account.set(self)
+        main.account_var.set(self.name)
+        main.logger.info(f"🚀 Starting account {self.name}")
+        main.recover_from_journal(self.exchange, self.order_journal)
+        if main.STREAM_MODE:
+            main.run_stream_mode(main.CcxtProStream(self.exchange.markets, self.exchange.currencies, self.credentials))
+        main.TickScheduler(main.main_job, main.TICK_INTERVAL, idle=main.cadence.poll_until).run_forever()
+
+
+def market_kind(config):
+    """Accounts of the same kind see the same markets, so they share one MarketCache."""
+    mock_options = account_mock_options(config)
+    if mock_options is None:
+        return 'phemex'
+    return 'mock:' + json.dumps(mock_options, sort_keys=True)
+
+
+def market_snapshot_file(kind):
+    if kind == 'phemex':
+        return main.MARKET_CACHE_FILE
+    digest = hashlib.sha1(kind.encode()).hexdigest()[:8]
+    return os.path.join(ACCOUNTS_STATE_DIR, f"market_cache.mock-{digest}.json")
+
+
+def market_caches(configs):
+    """One MarketCache per market kind among configs, each loaded by a client without credentials."""
+    os.makedirs(ACCOUNTS_STATE_DIR, exist_ok=True)
+    caches = {}
+    for config in configs:
+        kind = market_kind(config)
+        if kind not in caches:
+            client = main.create_exchange(account_mock_options(config), credentials={})
+            caches[kind] = main.MarketCache(client, snapshot_file=market_snapshot_file(kind))
+    return caches
+
+
+def exit_on_sigterm(signum, frame):
+    # A second TERM (the parent and the platform both send one) must not cut the final flush short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+
+def run_shard(configs, index=0):
+    """Runs the given accounts as threads of this process until it is stopped."""
+    main.setup_logging()
+    # One endpoint per process; metrics of the accounts in a process are summed
+    if main.METRICS_PORT:
+        main.start_metrics_server(main.METRICS_PORT + index)
+    caches = market_caches(configs)
+    for market_cache in caches.values():
+        market_cache.start()
+    accounts = [Account(config, caches[market_kind(config)]) for config in configs]
+
+    for name in ACCOUNT_GLOBALS:
+        setattr(main, name, AccountGlobal(name))
+
+    # Persist and fsync every account's trailing state and order journal on exit, including SIGTERM
+    for account in accounts:
+        atexit.register(account.trailing_store.close)
+        atexit.register(account.order_journal.close)
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
+    threads = [
+        threading.Thread(target=account.run, name=f"account-{account.name}", daemon=True)
+        for account in accounts
+    ]
+    for thread in threads:
+        thread.start()
+    # Join with a timeout so the main thread keeps handling signals
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+
+
+def split_shards(configs, processes):
+    return [configs[i::processes] for i in range(min(processes, len(configs)))]
+
+
+def run_accounts(config):
+    processes = max(1, int(config.get('processes', 1)))
+    shards = split_shards(config['accounts'], processes)
+    if len(shards) == 1:
+        run_shard(shards[0])
+        return
+
+    main.setup_logging()
+
+    # Load the markets once here; the workers start from the snapshots this writes
+    for market_cache in market_caches(config['accounts']).values():
+        market_cache.refresh()
+
+    # spawn, not fork: the workers start their own threads and clients
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=run_shard, args=(configs, i), name=f"accounts-{i}")
+        for i, configs in enumerate(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    main.logger.info(f"🚀 Running {len(config['accounts'])} accounts in {len(workers)} processes")
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    run_accounts(load_config(sys.argv[1] if len(sys.argv) > 1 else ACCOUNTS_FILE))
@@ -0,0 +1,368 @@
+"""Offline replay of the trailing-stop and re-entry strategy.
+
+Feeds recorded or synthetic mark-price series through the same rules the
+live bot uses (strategy.py) against a simulated isolated-margin exchange
+that handles re-entry fills, stop triggers and liquidations. All symbols
+and parameter sets advance together as array operations, skipping straight
+from one triggering bar to the next, and parameter grids can be split
+across processes.
+
+Price files are CSV or Parquet, either long (timestamp, symbol, mark_price)
+or wide (timestamp plus one column of mark prices per symbol). Parquet
+needs pyarrow or fastparquet, which the bot itself does not install.
+
+    python backtest.py --prices marks.parquet --breath-threshold 0.05 0.1 0.2
+    python backtest.py --synthetic 200 525600 --threshold 0.1 0.2 --processes 4
+"""
+import argparse
+import itertools
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from strategy import (
+    DEFAULT_PROFIT_TARGET_DISTANCE,
+    DEFAULT_THRESHOLD,
+    LOSING_PNL,
+    REENTRY_FROM_PERCENT,
+    reentry_levels,
+    trailing_signals,
+)
+
+MAINTENANCE_MARGIN_RATE = 0.005
+
+GRID_KEYS = ['breath_threshold', 'threshold', 'profit_target_distance', 'reentry_percent']
+
+
+def load_prices(path):
+    """Returns (symbols, prices) with prices as a bars x symbols float32 matrix."""
+    if path.endswith(".parquet"):
+        try:
+            frame = pd.read_parquet(path)
+        except ImportError as e:
+            raise SystemExit(f"Reading {path} needs a Parquet engine (pip install pyarrow): {e}")
+    else:
+        frame = pd.read_csv(path)
+    if {'symbol', 'mark_price'} <= set(frame.columns):
+        frame = frame.pivot(index='timestamp', columns='symbol', values='mark_price')
+    elif 'timestamp' in frame.columns:
+        frame = frame.set_index('timestamp')
+    frame = frame.sort_index().ffill().bfill()
+    return [str(c) for c in frame.columns], frame.to_numpy(dtype=np.float32)
+
+
+def synthetic_prices(n_symbols, n_bars, seed=0, volatility=0.001):
+    """Geometric random walks starting at 100, one column per symbol."""
+    rng = np.random.default_rng(seed)
+    log_returns = rng.standard_normal((n_bars, n_symbols), dtype=np.float32) * np.float32(volatility)
+    prices = np.exp(np.cumsum(log_returns, axis=0), dtype=np.float32) * np.float32(100)
+    return [f"SYN{i}/USDT:USDT" for i in range(n_symbols)], prices
+
+
+def load_source(source):
+    if source[0] == 'file':
+        return load_prices(source[1])
+    return synthetic_prices(*source[1:])
+
+
+BLOCK_BARS = 512
+
+COUNTERS = ['opens', 'stop_moves', 'stop_resets', 'stop_outs', 'liquidations', 'reentries', 'reentry_fills']
+
+
+class PriceIndex:
+    """Prices plus per-block highs and lows, used to jump straight to the next bar that can trigger anything."""
+
+    def __init__(self, prices, block=BLOCK_BARS):
+        self.n_bars = prices.shape[0]
+        self.block = block
+        self.n_blocks = -(-self.n_bars // block)
+        # Pad with the last price so every block is full; padded bars are never reported
+        padding = np.repeat(prices[-1:], self.n_blocks * block - self.n_bars, axis=0)
+        self.prices = np.concatenate([prices, padding])
+        blocks = self.prices.reshape(self.n_blocks, block, -1)
+        self.block_high = blocks.max(axis=1)
+        self.block_low = blocks.min(axis=1)
+        self.offsets = np.arange(block)
+
+    def scan(self, symbols, blocks, start, upper, lower):
+        bars = blocks[:, None] * self.block + self.offsets
+        window = self.prices[bars, symbols[:, None]]
+        hit = (bars >= start[:, None]) & ((window >= upper[:, None]) | (window <= lower[:, None]))
+        return hit.any(axis=1), bars[np.arange(len(bars)), hit.argmax(axis=1)]
+
+    def first_crossing(self, symbols, start, upper, lower):
+        """First bar >= start where each symbol trades at or above upper or at or below lower.
+
+        Returns n_bars for symbols that never cross.
+        """
+        result = np.full(len(symbols), self.n_bars)
+        first_block = start // self.block
+        found, bar = self.scan(symbols, first_block, start, upper, lower)
+        result[found] = bar[found]
+
+        rest = np.flatnonzero(~found)
+        if rest.size:
+            later = np.arange(self.n_blocks)[None, :] > first_block[rest][:, None]
+            rest_symbols = symbols[rest]
+            crosses = later & (
+                (self.block_high[:, rest_symbols].T >= upper[rest][:, None])
+                | (self.block_low[:, rest_symbols].T <= lower[rest][:, None])
+            )
+            has_cross = crosses.any(axis=1)
+            rest, crosses = rest[has_cross], crosses[has_cross]
+            if rest.size:
+                found, bar = self.scan(symbols[rest], crosses.argmax(axis=1), start[rest], upper[rest], lower[rest])
+                result[rest] = np.where(found, bar, self.n_bars)
+        return np.minimum(result, self.n_bars)
+
+
+class SimulatedBook:
+    """Isolated-margin positions of a simulated exchange, one cell per (parameter set, symbol)."""
+
+    def __init__(self, params, sides, leverage, notional):
+        n_params, n_symbols = len(params['threshold']), len(sides)
+        cells = n_params * n_symbols
+        self.param = np.repeat(np.arange(n_params), n_symbols)
+        self.symbol = np.tile(np.arange(n_symbols), n_params)
+        per_cell = lambda key: np.asarray(params[key], dtype=np.float64)[self.param]
+        self.breath, self.init_threshold, self.init_ptd, self.reentry_percent = (per_cell(key) for key in GRID_KEYS)
+        self.leverage = leverage
+        self.notional = notional
+
+        self.direction = np.where(np.asarray(sides, dtype=bool)[self.symbol], 1.0, -1.0)
+        self.is_open = np.zeros(cells, dtype=bool)
+        self.entry = np.zeros(cells)
+        self.contracts = np.zeros(cells)
+        self.margin = np.zeros(cells)
+        self.threshold = self.init_threshold.copy()
+        self.ptd = self.init_ptd.copy()
+        self.has_trailing = np.zeros(cells, dtype=bool)
+        self.stop = np.full(cells, np.nan)
+        self.pending_price = np.full(cells, np.nan)
+        self.pending_amount = np.zeros(cells)
+        self.realized = np.zeros(cells)
+        self.peak_margin = np.zeros(cells)
+        self.counts = {name: np.zeros(cells, dtype=np.int64) for name in COUNTERS}
+
+    def liquidation_price(self, cells):
+        d, entry = self.direction[cells], self.entry[cells]
+        contracts = np.where(self.contracts[cells] > 0, self.contracts[cells], 1)
+        return entry - d * (self.margin[cells] / contracts - MAINTENANCE_MARGIN_RATE * entry)
+
+    def barriers(self, cells):
+        """Price band each open cell can move in without any rule firing, as (upper, lower)."""
+        d = self.direction[cells]
+        entry = self.entry[cells]
+        # In direction-adjusted price (d * price) the move level is above, everything else below
+        favourable = d * entry * (1 + d * self.threshold[cells] / self.leverage)
+        reset_level = np.where(self.has_trailing[cells], entry + d * LOSING_PNL / self.contracts[cells], np.nan)
+        adverse = np.fmax.reduce([
+            d * self.stop[cells],
+            d * self.liquidation_price(cells),
+            d * self.pending_price[cells],
+            d * reset_level,
+        ])
+        upper = np.where(d > 0, favourable, -adverse)
+        lower = np.where(d > 0, adverse, -favourable)
+        # Slightly loose, so float rounding can only add a no-op step, never skip one
+        return upper - np.abs(upper) * 1e-9, lower + np.abs(lower) * 1e-9
+
+    def count(self, name, cells, mask):
+        self.counts[name][cells[mask]] += 1
+
+    def step(self, cells, mark):
+        """One bar for the given cells: fills, stops and liquidations, then the live decision step."""
+        d = self.direction[cells]
+        lev = self.leverage
+        is_open = self.is_open[cells]
+        entry, contracts, margin = self.entry[cells], self.contracts[cells], self.margin[cells]
+        threshold, ptd, has_trailing = self.threshold[cells], self.ptd[cells], self.has_trailing[cells]
+        stop, pending_price, pending_amount = self.stop[cells], self.pending_price[cells], self.pending_amount[cells]
+        init_threshold, init_ptd = self.init_threshold[cells], self.init_ptd[cells]
+
+        # Open (or reopen) at market with fresh trailing state
+        opening = ~is_open
+        entry = np.where(opening, mark, entry)
+        contracts = np.where(opening, self.notional / mark, contracts)
+        margin = np.where(opening, self.notional / lev, margin)
+        threshold = np.where(opening, init_threshold, threshold)
+        ptd = np.where(opening, init_ptd, ptd)
+        has_trailing &= ~opening
+        stop = np.where(opening, np.nan, stop)
+        pending_price = np.where(opening, np.nan, pending_price)
+        is_open = is_open | opening
+        self.count('opens', cells, opening)
+
+        # Stops sit between entry and liquidation, so they trigger first
+        stopped = is_open & (d * (mark - stop) <= 0)
+        self.realized[cells] += np.where(stopped, d * (stop - entry) * contracts, 0.0)
+        is_open &= ~stopped
+        self.count('stop_outs', cells, stopped)
+
+        contracts_safe = np.where(contracts > 0, contracts, 1)
+        liquidation = entry - d * (margin / contracts_safe - MAINTENANCE_MARGIN_RATE * entry)
+        liquidated = is_open & (d * (mark - liquidation) <= 0)
+        self.realized[cells] -= np.where(liquidated, margin, 0.0)
+        is_open &= ~liquidated
+        self.count('liquidations', cells, liquidated)
+
+        # Resting re-entry limits fill once the mark trades through them
+        filled = is_open & (d * (mark - pending_price) <= 0)
+        new_contracts = contracts + np.where(filled, pending_amount, 0.0)
+        entry = np.where(filled, (entry * contracts + pending_price * pending_amount) / new_contracts, entry)
+        margin = np.where(filled, margin + pending_price * pending_amount / lev, margin)
+        contracts = new_contracts
+        pending_price = np.where(filled, np.nan, pending_price)
+        liquidation = entry - d * (margin / np.where(contracts > 0, contracts, 1) - MAINTENANCE_MARGIN_RATE * entry)
+        self.count('reentry_fills', cells, filled)
+
+        # The live decision step: trailing stop first, then the re-entry check
+        _, _, _, new_stop, losing, move = trailing_signals(d > 0, entry, mark, contracts, lev, 0.0, threshold, ptd)
+        reset = is_open & losing & has_trailing
+        move &= is_open
+        stop = np.where(reset, np.nan, np.where(move, new_stop, stop))
+        threshold = np.where(reset, init_threshold, np.where(move, threshold + self.breath[cells], threshold))
+        ptd = np.where(reset, init_ptd, np.where(move, ptd + self.breath[cells], ptd))
+        has_trailing = (has_trailing & ~reset) | move
+        self.count('stop_resets', cells, reset)
+        self.count('stop_moves', cells, move)
+
+        placing = is_open & np.isnan(pending_price)
+        price, amount = reentry_levels(entry, liquidation, mark, contracts * mark, self.reentry_percent[cells])
+        pending_price = np.where(placing, price, pending_price)
+        pending_amount = np.where(placing, amount, pending_amount)
+        self.count('reentries', cells, placing)
+
+        self.is_open[cells] = is_open
+        self.entry[cells], self.contracts[cells], self.margin[cells] = entry, contracts, margin
+        self.threshold[cells], self.ptd[cells], self.has_trailing[cells] = threshold, ptd, has_trailing
+        self.stop[cells], self.pending_price[cells], self.pending_amount[cells] = stop, pending_price, pending_amount
+        self.peak_margin[cells] = np.maximum(self.peak_margin[cells], np.where(is_open, margin, 0.0))
+
+
+def simulate(prices, params, sides, leverage=10.0, notional=100.0, reopen=True):
+    """Replays prices through the strategy for every parameter set at once.
+
+    prices is bars x symbols, params maps each GRID_KEYS entry to an array
+    with one value per parameter set, and sides holds True for symbols traded
+    long. Balance is unlimited; peak margin shows how much the run needed.
+
+    Each (parameter set, symbol) cell jumps from one event bar to the next:
+    every rule is a price level, so bars where the price stays inside the
+    band of the current levels cannot change anything and are skipped.
+    Returns one stats dict per parameter set.
+    """
+    n_bars = prices.shape[0]
+    n_params = len(params['threshold'])
+    book = SimulatedBook(params, sides, leverage, notional)
+    if n_bars == 0:
+        return [{key: float(params[key][i]) for key in GRID_KEYS} for i in range(n_params)]
+    index = PriceIndex(prices)
+    cursor = np.full(len(book.param), -1)
+
+    while True:
+        live = cursor < n_bars - 1
+        if not reopen:
+            live &= book.is_open | (cursor < 0)
+        if not live.any():
+            break
+        next_bar = np.full(len(cursor), n_bars)
+        closed = live & ~book.is_open
+        next_bar[closed] = cursor[closed] + 1
+        waiting = np.flatnonzero(live & book.is_open)
+        if waiting.size:
+            upper, lower = book.barriers(waiting)
+            next_bar[waiting] = index.first_crossing(book.symbol[waiting], cursor[waiting] + 1, upper, lower)
+
+        cells = np.flatnonzero(next_bar < n_bars)
+        if cells.size:
+            book.step(cells, prices[next_bar[cells], book.symbol[cells]].astype(np.float64))
+        cursor = np.where(live, np.minimum(next_bar, n_bars - 1), cursor)
+
+    last_mark = prices[-1, book.symbol].astype(np.float64)
+    unrealized = np.where(book.is_open, book.direction * (last_mark - book.entry) * book.contracts, 0.0)
+    by_param = lambda values: values.reshape(n_params, -1)
+
+    results = []
+    for i in range(n_params):
+        row = {key: float(params[key][i]) for key in GRID_KEYS}
+        row.update({name: int(by_param(values)[i].sum()) for name, values in book.counts.items()})
+        row.update({
+            'realized_pnl': float(by_param(book.realized)[i].sum()),
+            'final_equity': float(by_param(book.realized + unrealized)[i].sum()),
+            'open_positions': int(by_param(book.is_open)[i].sum()),
+            'peak_position_margin': float(by_param(book.peak_margin)[i].max()),
+        })
+        results.append(row)
+    return results
+
+
+def symbol_sides(symbols, side):
+    if side == 'both':
+        return np.arange(len(symbols)) % 2 == 0
+    return np.full(len(symbols), side == 'long')
+
+
+def run_chunk(source, grid_chunk, side, leverage, notional, reopen):
+    # Each worker loads its own copy of the prices rather than receiving a pickled matrix
+    symbols, prices = load_source(source)
+    params = {key: np.array([combo[i] for combo in grid_chunk]) for i, key in enumerate(GRID_KEYS)}
+    return simulate(prices, params, symbol_sides(symbols, side), leverage, notional, reopen)
+
+
+def run_grid(source, grid, processes=1, side='long', leverage=10.0, notional=100.0, reopen=True):
+    """Sweeps every parameter combination in grid, split across processes."""
+    grid = list(grid)
+    processes = max(1, min(processes, len(grid)))
+    chunks = [grid[i::processes] for i in range(processes)]
+    args = (side, leverage, notional, reopen)
+    if processes == 1:
+        results = run_chunk(source, chunks[0], *args)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(run_chunk, source, chunk, *args) for chunk in chunks]
+            results = [row for future in futures for row in future.result()]
+    return pd.DataFrame(results).sort_values('final_equity', ascending=False, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the trailing-stop and re-entry strategy offline.")
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument('--prices', help="CSV or Parquet file of mark prices")
+    data.add_argument('--synthetic', nargs=2, type=int, metavar=('SYMBOLS', 'BARS'),
+                      help="generate random-walk prices instead")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--side', choices=['long', 'short', 'both'], default='long')
+    parser.add_argument('--leverage', type=float, default=10.0)
+    parser.add_argument('--notional', type=float, default=100.0, help="USDT notional of each opened position")
+    parser.add_argument('--no-reopen', action='store_true', help="don't reopen a position once it closes")
+    parser.add_argument('--breath-threshold', nargs='+', type=float, default=[0.10])
+    parser.add_argument('--threshold', nargs='+', type=float, default=[DEFAULT_THRESHOLD])
+    parser.add_argument('--profit-target-distance', nargs='+', type=float, default=[DEFAULT_PROFIT_TARGET_DISTANCE])
+    parser.add_argument('--reentry-percent', nargs='+', type=float, default=[REENTRY_FROM_PERCENT])
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--out', help="write the results table to this CSV file")
+    args = parser.parse_args()
+
+    source = ('file', args.prices) if args.prices else ('synthetic', *args.synthetic, args.seed)
+    grid = list(itertools.product(args.breath_threshold, args.threshold,
+                                  args.profit_target_distance, args.reentry_percent))
+
+    started = time.perf_counter()
+    results = run_grid(source, grid, args.processes, args.side, args.leverage, args.notional, not args.no_reopen)
+    elapsed = time.perf_counter() - started
+
+    pd.set_option('display.width', 200)
+    print(results.to_string())
+    print(f"\n⏱️ {len(grid)} parameter sets in {elapsed:.2f}s")
+    if args.out:
+        results.to_csv(args.out, index=False)
+
+
+if __name__ == "__main__":
+    main()
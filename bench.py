@@ -0,0 +1,315 @@
+"""Benchmarks main_job, cancel_orphan_orders and cleanup_closed_trailing_files against MockPhemex.
+
+For each position count this reports tick wall time, REST calls per tick
+(split by endpoint) and the peak Python heap of one tick, so regressions show
+up before a deploy. Bot output is silenced; every run starts from a fresh
+state directory so nothing touches the live trailing data.
+
+--paced instead runs the bot as deployed, TickScheduler with the adaptive
+poll rounds between ticks, for that many simulated seconds at the live
+endpoint budgets, once with ADAPTIVE_POLLING off and once on. It reports
+the weight each budget group spent per minute, polls included.
+
+    python bench.py                               # 10, 100 and 500 positions
+    python bench.py --positions 100 --latency 0.05 --ticks 10
+    python bench.py --positions 100 500 --paced 600
+"""
+import argparse
+import logging
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import main
+
+
+def setup_bot(mock_options, budget_scale=1.0):
+    """Points main's module globals at a fresh MockPhemex, as its __main__ block does for the live client."""
+    main.exchange = main.create_exchange(mock_options)
+    # Ticks run back to back here, so live per-minute budgets would dominate every number
+    budgets = {group: (limit * budget_scale, period) for group, (limit, period) in main.ENDPOINT_BUDGETS.items()}
+    main.exchange.scheduler = main.RequestScheduler(
+        1000 / main.exchange.rateLimit, budgets, main.endpoint_costs(main.exchange._exchange)
+    )
+    main.trailing_store = main.create_trailing_store()
+    main.order_journal = main.OrderJournal()
+    main.balance_cache = main.BalanceCache(main.exchange)
+    main.position_modes = main.PositionModeCache()
+    main.position_closes = main.PositionCloseTracker()
+    main.active_universe = main.ActiveUniverse()
+    main.cadence = main.CadencePlanner(main.exchange)
+    main.market_cache = main.MarketCache(main.exchange)
+    main.market_cache.start()
+    return main.exchange._exchange
+
+
+class SimulatedClock:
+    """Stands in for main's time module so a paced run takes simulated minutes, not real ones.
+
+    Time passes as usual while the bot works; a sleep skips straight ahead
+    instead of waiting. The market takes one random-walk step per simulated
+    second, so marks also move between ticks.
+    """
+
+    def __init__(self, mock):
+        self.mock = mock
+        self.offset = 0.0
+        self.started = time.monotonic()
+        self.steps = 0
+
+    def monotonic(self):
+        return time.monotonic() + self.offset
+
+    def elapsed(self):
+        return self.monotonic() - self.started
+
+    def sleep(self, seconds):
+        self.offset += max(0.0, seconds)
+        while self.steps < int(self.elapsed()):
+            self.steps += 1
+            self.mock.advance()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class SimulatedScheduler(main.RequestScheduler):
+    """RequestScheduler whose waits for budget skip ahead on a SimulatedClock."""
+
+    def __init__(self, clock, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.clock = clock
+
+    def wait_for_budget(self, delay):
+        self.clock.sleep(delay)
+
+
+class PacedRunDone(BaseException):
+    """Ends a paced run; not an Exception, so TickScheduler does not log and swallow it."""
+
+
+def measure(mock, job):
+    """Runs job; returns (seconds, REST calls by endpoint)."""
+    before = Counter(mock.calls)
+    started = time.perf_counter()
+    job()
+    elapsed = time.perf_counter() - started
+    return elapsed, Counter(mock.calls) - before
+
+
+def peak_memory(job):
+    tracemalloc.start()
+    try:
+        job()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_positions(n_positions, args):
+    mock = setup_bot({
+        'n_symbols': max(args.symbols, n_positions),
+        'n_positions': n_positions,
+        'seed': args.seed,
+        'latency': args.latency,
+        'rate_limit': args.rate_limit,
+        'hedge_ratio': args.hedge_ratio,
+        'report_pos_mode': not args.hide_pos_mode,
+    }, args.budget_scale)
+    symbols = main.market_cache.symbols
+    try:
+        # The first tick places a stop on every position, so it is reported on its own
+        first_tick, first_calls = measure(mock, main.main_job)
+
+        durations = []
+        calls = Counter()
+        for _ in range(args.ticks):
+            main.tick_stats.reset()
+            elapsed, tick_calls = measure(mock, main.main_job)
+            durations.append(elapsed)
+            calls += tick_calls
+        peak = peak_memory(main.main_job)
+
+        orphan_time, orphan_calls = measure(mock, lambda: main.cancel_orphan_orders(main.exchange, symbols, 'limit'))
+        cleanup_time, cleanup_calls = measure(mock, lambda: main.cleanup_closed_trailing_files(main.exchange, symbols))
+    finally:
+        main.market_cache.stop_event.set()
+        main.trailing_store.close()
+        main.order_journal.close()
+
+    return {
+        'positions': n_positions,
+        'first_tick': first_tick,
+        'first_calls': sum(first_calls.values()),
+        'tick_mean': statistics.mean(durations),
+        'tick_max': max(durations),
+        'calls_per_tick': sum(calls.values()) / args.ticks,
+        'calls_by_endpoint': {name: count / args.ticks for name, count in calls.most_common()},
+        'peak_mib': peak / 2 ** 20,
+        'orphans': orphan_time,
+        'orphan_calls': sum(orphan_calls.values()),
+        'cleanup': cleanup_time,
+        'cleanup_calls': sum(cleanup_calls.values()),
+        'rejected': sum(mock.rejected.values()),
+    }
+
+
+def bench_paced(n_positions, adaptive, args):
+    mock = setup_bot({
+        'n_symbols': max(args.symbols, n_positions),
+        'n_positions': n_positions,
+        'seed': args.seed,
+        'latency': args.latency,
+        'rate_limit': args.rate_limit,
+        # The mock's own limiter runs on real time; the scheduler enforces the budgets
+        'burst': 10 ** 6,
+        'hedge_ratio': args.hedge_ratio,
+        'report_pos_mode': not args.hide_pos_mode,
+        # The clock moves the market instead of every position fetch
+        'step_on_fetch': False,
+    })
+    main.cadence = main.CadencePlanner(main.exchange, tick_interval=args.tick_interval, enabled=adaptive)
+    clock = SimulatedClock(mock)
+    main.exchange.scheduler = SimulatedScheduler(
+        clock, 1000 / main.exchange.rateLimit, main.ENDPOINT_BUDGETS, main.endpoint_costs(mock)
+    )
+
+    def job():
+        if clock.elapsed() >= args.paced:
+            raise PacedRunDone()
+        main.main_job()
+
+    scheduler = main.TickScheduler(job, args.tick_interval, idle=main.cadence.poll_until)
+    main.time = clock
+    started = time.perf_counter()
+    try:
+        scheduler.run_forever()
+    except PacedRunDone:
+        pass
+    finally:
+        main.time = time
+        main.market_cache.stop_event.set()
+        main.trailing_store.close()
+        main.order_journal.close()
+
+    minutes = clock.elapsed() / 60
+    costs = main.endpoint_costs(mock)
+    weights = Counter()
+    for name, count in mock.calls.items():
+        group, weight = costs.get(name, ('contract', 1))
+        weights[group] += count * weight
+    return {
+        'positions': n_positions,
+        'adaptive': adaptive,
+        'minutes': minutes,
+        'real': time.perf_counter() - started,
+        'ticks': scheduler.ticks,
+        'overruns': scheduler.overruns,
+        'weight_per_min': {group: weight / minutes for group, weight in weights.items()},
+        'calls_per_min': {name: count / minutes for name, count in mock.calls.most_common()},
+        'rejected': sum(mock.rejected.values()),
+    }
+
+
+def format_paced_report(results, args):
+    budgets = main.ENDPOINT_BUDGETS
+    lines = [
+        f"MockPhemex: {args.symbols} symbols, latency {args.latency * 1000:g}ms, rateLimit {args.rate_limit:g}ms, "
+        f"live endpoint budgets, TickScheduler every {args.tick_interval:g}s for {args.paced:g} simulated seconds",
+        "",
+        f"{'positions':>9} {'adaptive':>8} {'ticks':>6} {'overruns':>8} "
+        + " ".join(f"{group + '/min':>14}" for group in budgets) + f" {'real':>7} {'429s':>5}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r['positions']:>9} {'on' if r['adaptive'] else 'off':>8} {r['ticks']:>6} {r['overruns']:>8} "
+            + " ".join(
+                f"{r['weight_per_min'].get(group, 0):>7.0f} of {limit * 60 / period:>4g}"
+                for group, (limit, period) in budgets.items()
+            )
+            + f" {r['real']:>6.1f}s {r['rejected']:>5}"
+        )
+    lines.append("")
+    for r in results:
+        breakdown = ", ".join(f"{name} {count:.1f}" for name, count in r['calls_per_min'].items())
+        lines.append(f"{r['positions']:>9} positions, adaptive {'on' if r['adaptive'] else 'off'}, calls per minute: {breakdown}")
+    return "\n".join(lines)
+
+
+def format_report(results, args):
+    lines = [
+        f"MockPhemex: {args.symbols} symbols, latency {args.latency * 1000:g}ms, "
+        f"rateLimit {args.rate_limit:g}ms, endpoint budgets x{args.budget_scale:g}, "
+        f"{args.ticks} ticks after a warm-up tick",
+        "",
+        f"{'positions':>9} {'1st tick':>9} {'calls':>6} {'tick avg':>9} {'tick max':>9} {'calls/tick':>10} "
+        f"{'peak MiB':>9} {'orphans':>8} {'calls':>6} {'cleanup':>8} {'calls':>6} {'429s':>5}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r['positions']:>9} {r['first_tick']:>8.2f}s {r['first_calls']:>6} {r['tick_mean']:>8.2f}s "
+            f"{r['tick_max']:>8.2f}s {r['calls_per_tick']:>10.1f} {r['peak_mib']:>9.2f} "
+            f"{r['orphans']:>7.2f}s {r['orphan_calls']:>6} {r['cleanup']:>7.2f}s {r['cleanup_calls']:>6} "
+            f"{r['rejected']:>5}"
+        )
+    lines.append("")
+    for r in results:
+        breakdown = ", ".join(f"{name} {count:g}" for name, count in r['calls_by_endpoint'].items())
+        lines.append(f"{r['positions']:>9} positions, calls per tick: {breakdown}")
+    return "\n".join(lines)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--positions', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--symbols', type=int, default=600, help="listed USDT swap markets")
+    parser.add_argument('--ticks', type=int, default=5, help="measured ticks per position count")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds added to every REST call")
+    parser.add_argument('--rate-limit', type=float, default=10.0,
+                        help="exchange rateLimit in ms (live phemex is 120.5)")
+    parser.add_argument('--budget-scale', type=float, default=10.0,
+                        help="multiplier on phemex's per-minute endpoint budgets (1 = live limits)")
+    parser.add_argument('--hedge-ratio', type=float, default=0.5, help="share of symbols in hedge mode")
+    parser.add_argument('--hide-pos-mode', action='store_true',
+                        help="leave posMode out of positions so mode errors and retries are exercised")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--paced', type=float, default=0,
+                        help="simulated seconds to run TickScheduler with and without adaptive polling")
+    parser.add_argument('--tick-interval', type=float, default=main.TICK_INTERVAL, help="tick interval of --paced runs")
+    parser.add_argument('--out', help="also write the report to this file")
+    args = parser.parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+    # The bot's own log would drown the report
+    logging.disable(logging.CRITICAL)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    results = []
+    for n_positions in args.positions:
+        if args.paced:
+            for adaptive in [False, True]:
+                run_dir = os.path.join(workdir, f"{n_positions}-{'adaptive' if adaptive else 'fixed'}")
+                os.makedirs(run_dir)
+                os.chdir(run_dir)
+                results.append(bench_paced(n_positions, adaptive, args))
+                print(f"✅ {n_positions} positions, adaptive {'on' if adaptive else 'off'}: "
+                      f"{results[-1]['real']:.1f}s for {results[-1]['minutes']:.1f} simulated minutes")
+            continue
+        run_dir = os.path.join(workdir, str(n_positions))
+        os.makedirs(run_dir)
+        os.chdir(run_dir)
+        results.append(bench_positions(n_positions, args))
+        print(f"✅ {n_positions} positions: {results[-1]['tick_mean']:.2f}s per tick")
+
+    report = format_paced_report(results, args) if args.paced else format_report(results, args)
+    print()
+    print(report)
+    if out:
+        with open(out, "w") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,20 +1,193 @@
 import ccxt
+import abc
+import asyncio
+import atexit
+import contextvars
+import copy
+import heapq
+import itertools
 import os
 import time
 import threading
 import queue
 import json
+import logging
+import logging.handlers
 import math
-import schedule
-import traceback
+import re
+import signal
+import sqlite3
+import sys
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
 from dotenv import load_dotenv
 
+from metrics import REGISTRY, serve as serve_metrics
+from strategy import (
+    DEFAULT_PROFIT_TARGET_DISTANCE,
+    DEFAULT_THRESHOLD,
+    liquidation_closeness,
+    reentry_levels,
+    trailing_signals,
+)
+
+try:
+    import ccxt.pro as ccxtpro
+except ImportError:  # older ccxt without the bundled pro package
+    ccxtpro = None
+
 load_dotenv()
 
 api_key = os.getenv('API_KEY')
 secret = os.getenv('SECRET')
 
+# Number of positions processed concurrently on each tick
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '8'))
+
+# Market metadata is refreshed in the background every MARKET_CACHE_TTL seconds
+MARKET_CACHE_TTL = int(os.getenv('MARKET_CACHE_TTL', '3600'))
+MARKET_CACHE_FILE = os.getenv('MARKET_CACHE_FILE', 'market_cache.json')
+
+# Per-symbol hedge/one-way mode, learned from positions and order errors
+POSITION_MODE_FILE = os.getenv('POSITION_MODE_FILE', 'position_modes.json')
+
+# Free balance is re-fetched at most every BALANCE_TTL seconds unless an account event invalidates it
+BALANCE_TTL = float(os.getenv('BALANCE_TTL', '60'))
+
+# main_job runs at a fixed rate of one tick every TICK_INTERVAL seconds
+TICK_INTERVAL = float(os.getenv('TICK_INTERVAL', '10'))
+
+# ADAPTIVE_POLLING=1 re-reads positions near a trailing or liquidation
+# threshold between ticks, down to ADAPTIVE_MIN_INTERVAL seconds, in at most
+# ADAPTIVE_POLL_RATE position calls a second; stable positions only get their
+# open-orders and re-entry check every ADAPTIVE_STABLE_INTERVAL
+ADAPTIVE_POLLING = os.getenv('ADAPTIVE_POLLING', '1') == '1'
+ADAPTIVE_MIN_INTERVAL = float(os.getenv('ADAPTIVE_MIN_INTERVAL', '0.5'))
+ADAPTIVE_POLL_RATE = float(os.getenv('ADAPTIVE_POLL_RATE', '2'))
+ADAPTIVE_STABLE_INTERVAL = float(os.getenv('ADAPTIVE_STABLE_INTERVAL', '60'))
+ADAPTIVE_STABLE_BELOW = float(os.getenv('ADAPTIVE_STABLE_BELOW', '0.3'))
+
+# STREAM_MODE=1 reacts to websocket events and keeps REST polling for reconciliation
+STREAM_MODE = os.getenv('STREAM_MODE', '0') == '1'
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', '60'))
+
+# Ticks only fetch symbols with positions, orders or trailing state; a full
+# account-wide position fetch runs every UNIVERSE_SWEEP_INTERVAL seconds
+UNIVERSE_SWEEP_INTERVAL = float(os.getenv('UNIVERSE_SWEEP_INTERVAL', '60'))
+
+# EXCHANGE=mock trades against the local MockPhemex (see mock_exchange.py) instead of the live API
+EXCHANGE = os.getenv('EXCHANGE', 'phemex')
+MOCK_POSITIONS = int(os.getenv('MOCK_POSITIONS', '10'))
+MOCK_LATENCY = float(os.getenv('MOCK_LATENCY', '0.05'))
+
+# LOG_LEVEL filters the log; LOG_FORMAT=json writes one JSON object per line instead of text
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+# Position and order records keep their raw ccxt payload only when debugging
+KEEP_RAW_PAYLOADS = LOG_LEVEL == 'DEBUG'
+
+# Prometheus metrics are served on localhost:METRICS_PORT/metrics; 0 turns them off
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+logger = logging.getLogger("cryptsel")
+
+# Name of the account a log line or metric belongs to, set by the multi-account runner
+account_var = contextvars.ContextVar('account', default='')
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the account while still on the thread that logged them."""
+
+    def filter(self, record):
+        record.account = account_var.get() or '-'
+        return True
+
+
+# Attributes every LogRecord has; anything else was passed through extra=
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {'message', 'asctime', 'account'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'account': getattr(record, 'account', '-'),
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in LOG_RECORD_FIELDS})
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """Routes all logging through a queue drained by a background thread.
+
+    Threads only enqueue records, so a slow stdout never stalls the tick loop.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s [%(account)s] %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def start_metrics_server(port=METRICS_PORT):
+    if not port:
+        return None
+    try:
+        server = serve_metrics(port)
+    except OSError as e:
+        logger.warning(f"⚠️ Metrics endpoint not started on port {port}: {e}")
+        return None
+    logger.info(f"📈 Metrics on http://127.0.0.1:{port}/metrics")
+    return server
+
+
+# Accounts run side by side in one process, so every series is per account
+REGISTRY.add_context_label('account', account_var.get)
+
+EXCHANGE_LATENCY = REGISTRY.histogram('exchange_request_seconds', 'Latency of exchange REST calls', ['endpoint'])
+EXCHANGE_WAIT = REGISTRY.histogram('exchange_queue_wait_seconds', 'Time REST calls waited for the request scheduler', ['priority'])
+EXCHANGE_ERRORS = REGISTRY.counter('exchange_errors_total', 'Failed exchange REST calls by error code', ['endpoint', 'code'])
+EXCHANGE_COALESCED = REGISTRY.counter('exchange_coalesced_total', 'Reads answered by an identical request already in flight', ['endpoint'])
+EXCHANGE_QUEUE_DEPTH = REGISTRY.gauge('exchange_queue_depth', 'REST calls waiting for the request scheduler')
+TICK_DURATION = REGISTRY.histogram('tick_duration_seconds', 'Wall time of one tick')
+TICK_STAGE = REGISTRY.histogram('tick_stage_seconds', 'Time spent in each tick stage', ['stage'])
+TICK_OVERRUNS = REGISTRY.counter('tick_overruns_total', 'Ticks that ran past their interval')
+POSITIONS_PROCESSED = REGISTRY.counter('positions_processed_total', 'Positions run through the risk pass')
+OPEN_POSITIONS = REGISTRY.gauge('open_positions', 'Open positions in the latest tick')
+STOP_MOVES = REGISTRY.counter('stop_moves_total', 'Stop-loss moves by outcome', ['result'])
+STOP_CANCELS = REGISTRY.counter('stop_cancels_total', 'Trailing stops dropped because the position turned into a loss')
+REENTRIES = REGISTRY.counter('reentries_total', 'Re-entry orders by outcome', ['result'])
+RETRIES = REGISTRY.counter('retries_total', 'Exchange calls retried or redone after an error, by error code', ['code'])
+CACHE_REQUESTS = REGISTRY.counter('cache_requests_total', 'Cache lookups by cache and outcome', ['cache', 'result'])
+POLLED_SYMBOLS = REGISTRY.counter('polled_symbols_total', 'Symbols re-read between ticks by the adaptive cadence')
+
+
+def error_code(e):
+    """phemex's error name or code from an exchange error, else the exception type."""
+    text = str(e)
+    match = re.search(r'"msg"\s*:\s*"([A-Z][A-Z0-9_]+)"', text) or re.search(r'"code"\s*:\s*(\d+)', text)
+    if match:
+        return match.group(1)
+    return 'TE_ERR_INCONSISTENT_POS_MODE' if 'TE_ERR_INCONSISTENT_POS_MODE' in text else type(e).__name__
+
 def count_sig_digits(precision):
     # Count digits after decimal point if it's a fraction
     if precision < 1:
@@ -31,522 +204,2421 @@ def round_to_sig_figs(num, sig_figs):
 def calculateLiquidationTargPrice(_liqprice, _entryprice, _percnt, _round):
     return round_to_sig_figs(_entryprice + (_liqprice - _entryprice) * _percnt, _round)
 
-def reEnterTrade(exchange, symbol, order_side, order_price, order_amount, order_type):
+def reserve_reentry(symbol, order_price, order_amount, leverage=1):
+    """Reserves the margin of a re-entry order; returns the reserved cost, or None to skip it."""
+    # Check if symbol is futures (adjust this check to your actual symbol format)
+    if ":USDT" not in symbol:
+        logger.warning(f"Skipping re-entry order for non-futures symbol: {symbol}")
+        REENTRIES.inc(result='skipped')
+        return None
+
+    # Margin the order locks up, checked against the cached balance
+    estimated_cost = order_amount * order_price / leverage
+    if not balance_cache.try_reserve(estimated_cost):
+        logger.warning(f"⚠️ Insufficient USDT balance ({balance_cache.free()}) for order cost ({estimated_cost}). Skipping order.")
+        REENTRIES.inc(result='insufficient_balance')
+        return None
+    return estimated_cost
+
+
+def reentry_order(symbol, order_side, order_price, order_amount, order_type, client_order_id):
+    """create_order arguments of a re-entry, as a function of the posSide params."""
+    return lambda mode_params: {
+        'symbol': symbol,
+        'type': order_type,
+        'side': order_side,
+        'amount': order_amount,
+        'price': order_price,
+        'params': {
+            'reduceOnly': False,
+            'clientOrderId': client_order_id,
+            **mode_params
+        },
+    }
+
+
+def journal_reentry(symbol, order_side, order_price, order_amount):
+    """Journals a re-entry before it is sent; returns its client order id."""
+    cid = order_journal.client_order_id()
+    order_journal.intent(cid, 'reentry', symbol, order_side, price=order_price, amount=order_amount)
+    return cid
+
+
+def reentry_failed(symbol, e):
+    REENTRIES.inc(result='failed')
+    # Handle specific phemex error for pilot contract
+    if 'Pilot contract is not allowed here' in str(e):
+        logger.error(f"❌ Phemex error: Pilot contract is not allowed for {symbol}. Skipping order.")
+    else:
+        logger.error(f"❌ Error placing re-entry Limit order: {e}")
+
+
+def reEnterTrade(exchange, symbol, order_side, order_price, order_amount, order_type, leverage=1):
+    estimated_cost = reserve_reentry(symbol, order_price, order_amount, leverage)
+    if estimated_cost is None:
+        return
+
+    placed = False
+    cid = journal_reentry(symbol, order_side, order_price, order_amount)
     try:
-        # Check if symbol is futures (adjust this check to your actual symbol format)
-        if ":USDT" not in symbol:
-            print(f"Skipping re-entry order for non-futures symbol: {symbol}")
-            return
+        # posSide is only sent when the symbol is known to be in hedge mode
+        pos_side = 'Long' if order_side == 'buy' else 'Short'
+        order = reentry_order(symbol, order_side, order_price, order_amount, order_type, cid)
+        placed_order = with_position_mode(symbol, pos_side, lambda mode_params: exchange.create_order(**order(mode_params)))
+        order_journal.done(cid, placed_order.get('id'))
+        active_universe.note_order(symbol)
+        placed = True
+        REENTRIES.inc(result='placed')
+        logger.info(f"✅ Re-entry order placed: {order_side} {order_amount} @ {order_price}")
 
-        # Fetch balance once
-        balance_info = exchange.fetch_balance({'type': 'swap'})
-        usdt_balance = balance_info.get('USDT', {}).get('free', 0)
-        
-        estimated_cost = order_amount * order_price
-        
-        # if usdt_balance < estimated_cost:
-        #     print(f"⚠️ Insufficient USDT balance ({usdt_balance}) for order cost ({estimated_cost}). Skipping order.")
-        #     return
-        
-        # First attempt: without posSide (works in one-way mode)
-        order = exchange.create_order(
-            symbol=symbol,
-            type=order_type,
-            side=order_side,
-            amount=order_amount,
-            price=order_price,
-            params={
-                'reduceOnly': False
-            }
-        )
-        print(f"✅ Re-entry order placed: {order_side} {order_amount} @ {order_price}")
-        
     except ccxt.BaseError as e:
-        error_msg = str(e)
-        # Handle specific phemex error for pilot contract
-        if 'Pilot contract is not allowed here' in error_msg:
-            print(f"❌ Phemex error: Pilot contract is not allowed for {symbol}. Skipping order.")
-            return
-        
-        # If failed due to position mode, retry with posSide
-        if 'TE_ERR_INCONSISTENT_POS_MODE' in error_msg:
-            print("🔁 Retrying with (Limit) posSide due to inconsistent position mode...")
-            pos_side = 'Long' if order_side == 'buy' else 'Short'
-            try:
-                order = exchange.create_order(
-                    symbol=symbol,
-                    type=order_type,
-                    side=order_side,
-                    amount=order_amount,
-                    price=order_price,
-                    params={
-                        'reduceOnly': False,
-                        'posSide': pos_side
-                    }
-                )
-                print(f"✅ Re-entry Limit order (with posSide) placed: {order_side} {order_amount} @ {order_price}")
-            except ccxt.BaseError as e2:
-                print(f"❌ Re-entry Limit order failed even with posSide: {e2}")
+        order_journal.failed(cid, e)
+        reentry_failed(symbol, e)
+    finally:
+        if not placed:
+            balance_cache.release(estimated_cost)
+
+
+class Position:
+    """The fields of a ccxt position the bot reads, parsed once when it is fetched."""
+
+    __slots__ = (
+        'symbol', 'side', 'contracts', 'entry_price', 'mark_price', 'liquidation_price',
+        'leverage', 'notional', 'realized_pnl', 'pos_mode', 'raw',
+    )
+
+    def __init__(self, symbol, side, contracts, entry_price, mark_price, liquidation_price,
+                 leverage=1.0, notional=0.0, realized_pnl=0.0, pos_mode=None, raw=None):
+        self.symbol = symbol
+        self.side = side
+        self.contracts = contracts
+        self.entry_price = entry_price
+        self.mark_price = mark_price
+        self.liquidation_price = liquidation_price
+        self.leverage = leverage
+        self.notional = notional
+        self.realized_pnl = realized_pnl
+        self.pos_mode = pos_mode
+        self.raw = raw
+
+    @classmethod
+    def parse(cls, position):
+        info = position.get('info') or {}
+        if info.get('posMode'):
+            pos_mode = 'hedge' if info['posMode'] == 'Hedged' else 'oneway'
+        elif info.get('posSide') in ['Long', 'Short']:
+            pos_mode = 'hedge'
+        elif info.get('posSide') == 'Merged':
+            pos_mode = 'oneway'
         else:
-            print(f"❌ Error placing re-entry Limit order: {e}")
+            pos_mode = None
+        return cls(
+            position['symbol'],
+            (position.get('side') or '').lower(),
+            float(position.get('contracts') or position.get('size') or 0),
+            float(position.get('entryPrice') or 0),
+            float(position.get('markPrice') or 0),
+            float(position.get('liquidationPrice') or 0),
+            float(position.get('leverage') or 1),
+            float(position.get('notional') or 0),
+            float(info.get('curTermRealisedPnlRv') or 0),
+            pos_mode,
+            position if KEEP_RAW_PAYLOADS else None,
+        )
+
+    @property
+    def is_open(self):
+        return self.contracts > 0 and self.side in ['long', 'short']
+
+    def __repr__(self):
+        return f"Position({self.symbol} {self.side} {self.contracts:g} @ {self.entry_price:g})"
+
+
+class Order:
+    """The fields of a ccxt open order the bot reads, parsed once when it is fetched."""
+
+    __slots__ = ('id', 'client_order_id', 'symbol', 'side', 'type', 'amount', 'price', 'trigger_price', 'raw')
+
+    def __init__(self, id, client_order_id, symbol, side, type, amount, price=None, trigger_price=None, raw=None):
+        self.id = id
+        self.client_order_id = client_order_id
+        self.symbol = symbol
+        self.side = side
+        self.type = type
+        self.amount = amount
+        self.price = price
+        self.trigger_price = trigger_price
+        self.raw = raw
+
+    @classmethod
+    def parse(cls, order):
+        trigger_price = order.get('triggerPrice') or order.get('stopPrice')
+        return cls(
+            order['id'],
+            order.get('clientOrderId'),
+            order['symbol'],
+            (order.get('side') or '').lower(),
+            order.get('type'),
+            float(order.get('amount') or 0),
+            float(order['price']) if order.get('price') else None,
+            float(trigger_price) if trigger_price else None,
+            order if KEEP_RAW_PAYLOADS else None,
+        )
+
+    def __repr__(self):
+        return f"Order({self.id} {self.symbol} {self.side} {self.type})"
+
+
+def parse_positions(positions):
+    return [Position.parse(position) for position in positions]
+
 
-            
 def get_position(exchange, symbol):
-    positions = exchange.fetch_positions([symbol])
-    for p in positions:
-        if float(p.get('contracts') or 0) > 0:
-            return p
+    for position in parse_positions(exchange.fetch_positions([symbol])):
+        if position.contracts > 0:
+            return position
     return None
-    
-def cancel_orphan_orders(exchange, all_symbols, order_type):
+
+
+class OpenOrdersSnapshot:
+    """Open orders fetched once per tick as Order records, indexed by (symbol, side, type)."""
+
+    # Set once the exchange rejects an account-wide fetch (Phemex needs a symbol)
+    needs_symbol = False
+
+    def __init__(self, orders, symbols):
+        self.symbols = set(symbols)
+        # symbol -> (side, type) -> orders
+        self.index = {}
+        for order in orders:
+            order = Order.parse(order)
+            self.index.setdefault(order.symbol, {}).setdefault((order.side, order.type), []).append(order)
+
+    @classmethod
+    def fetch(cls, exchange, symbols):
+        symbols = list(symbols)
+        if not cls.needs_symbol:
+            try:
+                orders = exchange.fetch_open_orders()
+                wanted = set(symbols)
+                return cls([o for o in orders if o['symbol'] in wanted], symbols)
+            except ccxt.ArgumentsRequired:
+                cls.needs_symbol = True
+
+        def fetch_symbol(symbol):
+            try:
+                return exchange.fetch_open_orders(symbol)
+            except Exception as e:
+                logger.error(f"Error fetching open orders for {symbol}: {e}")
+                return None
+
+        # A single symbol is fetched inline, which is also safe from inside a pool worker
+        results = map(fetch_symbol, symbols) if len(symbols) <= 1 else pool_map(fetch_symbol, symbols)
+        orders, fetched = [], []
+        for symbol, symbol_orders in zip(symbols, results):
+            if symbol_orders is not None:
+                orders.extend(symbol_orders)
+                fetched.append(symbol)
+        return cls(orders, fetched)
+
+    def has_symbol(self, symbol):
+        return symbol in self.symbols
+
+    def orders(self, symbol, side=None, order_type=None):
+        if side is not None and order_type is not None:
+            return list(self.index.get(symbol, {}).get((side, order_type), []))
+        return [
+            order
+            for (o_side, o_type), orders in self.index.get(symbol, {}).items()
+            if (side is None or o_side == side)
+            and (order_type is None or o_type == order_type)
+            for order in orders
+        ]
+
+
+class PositionModeCache:
+    """Per-symbol position mode ('hedge' or 'oneway'), persisted across restarts.
+
+    Filled from position payloads and from TE_ERR_INCONSISTENT_POS_MODE
+    failures, so orders go out with the right posSide on the first try.
+    """
+
+    def __init__(self, path=POSITION_MODE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.modes = json.load(f)
+        except (OSError, ValueError):
+            self.modes = {}
+
+    def get(self, symbol):
+        mode = self.modes.get(symbol)
+        CACHE_REQUESTS.inc(cache='position_mode', result='hit' if mode else 'miss')
+        return mode
+
+    def set(self, symbol, mode):
+        self.update({symbol: mode})
+
+    def update(self, modes):
+        """Records several modes with at most one write of the file."""
+        with self.lock:
+            changed = {symbol: mode for symbol, mode in modes.items() if self.modes.get(symbol) != mode}
+            if not changed:
+                return
+            self.modes.update(changed)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.modes, f, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def learn(self, positions):
+        self.update({position.symbol: position.pos_mode for position in positions if position.pos_mode})
+
+
+def position_mode_params(mode, pos_side):
+    return {'posSide': pos_side} if mode == 'hedge' else {}
+
+
+def is_pos_mode_error(e):
+    return "TE_ERR_INCONSISTENT_POS_MODE" in str(e)
+
+
+def with_position_mode(symbol, pos_side, request, default='oneway', rejected_mode=None):
+    """Calls request(mode_params) using the symbol's cached position mode.
+
+    mode_params is {'posSide': pos_side} in hedge mode and {} in one-way mode.
+    If the exchange answers TE_ERR_INCONSISTENT_POS_MODE the other mode is
+    tried once; whichever mode succeeds is remembered. rejected_mode is a mode
+    a bulk call already saw rejected, which goes straight to the other one.
+    """
+    mode = position_modes.get(symbol) or default
+    try:
+        if mode == rejected_mode:
+            raise ccxt.ExchangeError("TE_ERR_INCONSISTENT_POS_MODE")
+        result = request(position_mode_params(mode, pos_side))
+    except Exception as e:
+        if not is_pos_mode_error(e):
+            raise
+        mode = 'oneway' if mode == 'hedge' else 'hedge'
+        RETRIES.inc(code='TE_ERR_INCONSISTENT_POS_MODE')
+        logger.info(f"🔁 {symbol} is in {mode} mode, retrying")
+        result = request(position_mode_params(mode, pos_side))
+    position_modes.set(symbol, mode)
+    return result
+
+
+def cancel_order_with_mode(exchange, order):
+    """Cancels one Order with the posSide retry; returns whether it was cancelled."""
+    symbol = order.symbol
+    pos_side = "Long" if order.side == "buy" else "Short"
+    try:
+        with_position_mode(symbol, pos_side, lambda mode_params: exchange.cancel_order(order.id, symbol, mode_params))
+        return True
+    except ccxt.OrderNotFound:
+        # Already filled or cancelled, e.g. by a bulk cancel that failed halfway
+        return True
+    except Exception as e:
+        logger.error(f"Error cancelling order: {e}")
+        return False
+
+
+def is_conditional(order):
+    return order.type == 'stop' or bool(order.trigger_price)
+
+
+class OrderBatch:
+    """Order creates and cancels gathered over a tick, sent in as few calls as the exchange allows.
+
+    Cancels go out as one cancel_orders call per symbol where supported, else
+    as one raw phemex bulk cancel (DELETE g-orders) per symbol and posSide,
+    else as one cancel_all_orders per symbol when the open-orders snapshot
+    shows every resting order of that symbol is being cancelled. Whatever is
+    left goes out one call per order. Creates go out through create_orders where supported, else one by
+    one. Every request gets its own outcome, and orders a bulk call rejected
+    with TE_ERR_INCONSISTENT_POS_MODE are retried alone in the other mode.
+    """
+
+    def __init__(self, exchange, open_orders=None):
+        self.exchange = exchange
+        self.open_orders = open_orders
+        self.creates = []
+        self.cancels = []
+
+    def create(self, symbol, pos_side, order, default='oneway'):
+        """Queues a create; order(mode_params) returns its create_order arguments."""
+        self.creates.append((symbol, pos_side, order, default))
+
+    def cancel(self, order):
+        self.cancels.append(order)
+
+    def send_cancels(self):
+        """Sends the queued cancels; returns the symbols where an order could not be cancelled."""
+        by_symbol = {}
+        for order in self.cancels:
+            by_symbol.setdefault(order.symbol, []).append(order)
+        self.cancels = []
+        results = pool_map(lambda item: self.cancel_symbol(*item), list(by_symbol.items()))
+        return [symbol for symbol, cancelled in zip(by_symbol, results) if not cancelled]
+
+    def cancel_symbol(self, symbol, orders):
+        if len(orders) > 1:
+            try:
+                if self.exchange.has.get('cancelOrders'):
+                    cancelled = self.exchange.cancel_orders([order.id for order in orders], symbol) or []
+                    cancelled_ids = {
+                        str(order.get('id')) for order in cancelled
+                        if isinstance(order, dict) and order.get('status') != 'rejected'
+                    }
+                    orders = [order for order in orders if order.id not in cancelled_ids]
+                    if orders:
+                        logger.info(f"{symbol} orders {[order.id for order in orders]} not cancelled in bulk, retrying alone")
+                elif hasattr(self.exchange, 'private_delete_g_orders'):
+                    orders = self.cancel_bulk(symbol, orders)
+                elif self.exchange.has.get('cancelAllOrders') and self.covers_resting(symbol, orders):
+                    self.exchange.cancel_all_orders(symbol)
+                    return True
+            except Exception as e:
+                logger.warning(f"⚠️ Bulk cancel for {symbol} failed: {e} — cancelling one by one")
+        return all([cancel_order_with_mode(self.exchange, order) for order in orders])
+
+    def cancel_bulk(self, symbol, orders):
+        """Cancels through phemex's DELETE g-orders, one call per posSide; returns the orders left open.
+
+        The endpoint takes a comma-separated orderID list for one symbol and
+        posSide and answers with a bizError per order, so each failure is
+        matched back to its order id.
+        """
+        market_id = self.exchange.market(symbol)['id']
+        by_pos_side = {}
+        for order in orders:
+            by_pos_side.setdefault("Long" if order.side == "buy" else "Short", []).append(order)
+        left = []
+        for pos_side, group in by_pos_side.items():
+            params = {'symbol': market_id, 'orderID': ','.join(order.id for order in group)}
+            try:
+                response = with_position_mode(
+                    symbol, pos_side,
+                    lambda mode_params: self.exchange.private_delete_g_orders(
+                        {**params, 'posSide': mode_params.get('posSide', 'Merged')}
+                    ),
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Bulk cancel of {len(group)} {symbol} orders failed: {e}")
+                left += group
+                continue
+            results = {str(item.get('orderID')): item for item in response.get('data') or [] if isinstance(item, dict)}
+            for order in group:
+                result = results.get(order.id)
+                if result is None or result.get('bizError'):
+                    error = result.get('bizError') if result else 'missing from the response'
+                    logger.info(f"{symbol} order {order.id} not cancelled in bulk ({error}), retrying alone")
+                    left.append(order)
+        return left
+
+    def covers_resting(self, symbol, orders):
+        # cancel_all_orders leaves conditional (stop) orders alone
+        if self.open_orders is None or not self.open_orders.has_symbol(symbol):
+            return False
+        resting = {order.id for order in self.open_orders.orders(symbol) if not is_conditional(order)}
+        return resting == {order.id for order in orders}
+
+    def send_creates(self):
+        """Sends the queued creates; returns the placed order or the exception for each, in order."""
+        creates, self.creates = self.creates, []
+        if len(creates) > 1 and self.exchange.has.get('createOrders'):
+            return self.create_bulk(creates)
+        return list(pool_map(self.create_one, creates))
+
+    def create_one(self, request, rejected_mode=None):
+        symbol, pos_side, order, default = request
+        try:
+            return with_position_mode(
+                symbol, pos_side, lambda mode_params: self.exchange.create_order(**order(mode_params)),
+                default, rejected_mode,
+            )
+        except Exception as e:
+            return e
+
+    def create_bulk(self, creates):
+        modes = [position_modes.get(symbol) or default for symbol, _, _, default in creates]
+        orders = [
+            order(position_mode_params(mode, pos_side))
+            for (symbol, pos_side, order, default), mode in zip(creates, modes)
+        ]
+        try:
+            placed = list(self.exchange.create_orders(orders))
+        except Exception as e:
+            logger.warning(f"⚠️ Bulk create of {len(orders)} orders failed: {e} — placing one by one")
+            return list(pool_map(self.create_one, creates))
+
+        placed += [{}] * (len(creates) - len(placed))
+        results = []
+        for request, mode, order in zip(creates, modes, placed):
+            symbol = request[0]
+            if order.get('id'):
+                position_modes.set(symbol, mode)
+                results.append(order)
+                continue
+            # Rejected inside the batch; the reason is in the raw response
+            error = ccxt.ExchangeError(f"{symbol} rejected: {order.get('info')}")
+            results.append(self.create_one(request, rejected_mode=mode) if is_pos_mode_error(error) else error)
+        return results
+
+
+def cancel_orphan_orders(exchange, all_symbols, order_type, open_orders=None, positions=None):
     try:
         positions_map = {}
         try:
-            # Fetch positions for all symbols once
-            all_positions = exchange.fetch_positions(symbols=all_symbols)
-            for p in all_positions:
-                symbol = p['symbol']
-                contracts = float(p.get('contracts') or p.get('size') or 0)
-                side = p.get('side', '').lower()
-                positions_map[symbol] = {
-                    'has_position': contracts > 0,
-                    'side': side
+            # Fetch positions for all symbols once, unless the tick's snapshot was passed in
+            if positions is None:
+                positions = parse_positions(exchange.fetch_positions(symbols=all_symbols))
+            for p in positions:
+                positions_map[p.symbol] = {
+                    'has_position': p.contracts > 0,
+                    'side': p.side
                 }
         except Exception as e:
-            print("Error fetching positions:", e)
+            logger.error(f"Error fetching positions: {e}")
             return
 
+        if open_orders is None:
+            open_orders = OpenOrdersSnapshot.fetch(exchange, all_symbols)
+
+        batch = OrderBatch(exchange, open_orders)
         for symbol in all_symbols:
             try:
-                open_orders = exchange.fetch_open_orders(symbol)
-                if not open_orders:
+                symbol_orders = open_orders.orders(symbol, order_type=order_type)
+                if not symbol_orders:
                     continue
 
                 position_info = positions_map.get(symbol, {'has_position': False, 'side': None})
                 has_position = position_info['has_position']
                 current_side = position_info['side']
 
-                for order in open_orders:
-                    if order['type'] != order_type:
-                        continue
-
-                    order_side = order['side'].lower()  # 'buy' or 'sell'
+                for order in symbol_orders:
+                    order_side = order.side  # 'buy' or 'sell'
 
                     # Cancel all limit orders if no position exists
                     if not has_position:
-                        print(f"❌ Cancelling orphaned {order_side.upper()} {order_type} order for {symbol} (no position)")
-                        try:
-                            exchange.cancel_order(order['id'], symbol)
-                        except Exception as e:
-                            if "TE_ERR_INCONSISTENT_POS_MODE" in str(e):
-                                pos_side_str = "Long" if order_side == "buy" else "Short"
-                                print(f"Retrying cancel with posSide={pos_side_str}")
-                                exchange.cancel_order(order['id'], symbol, {'posSide': pos_side_str})
-                            else:
-                                print(f"Error cancelling order: {e}")
+                        logger.info(f"❌ Cancelling orphaned {order_side.upper()} {order_type} order for {symbol} (no position)")
+                        batch.cancel(order)
                         continue
 
                     # Cancel limit orders that do not match the position side
                     if (order_side == 'buy' and current_side != 'long') or (order_side == 'sell' and current_side != 'short'):
-                        print(f"⚠️ Cancelling mismatched {order_side.upper()} {order_type} order for {symbol} (position side: {current_side})")
-                        try:
-                            exchange.cancel_order(order['id'], symbol)
-                        except Exception as e:
-                            if "TE_ERR_INCONSISTENT_POS_MODE" in str(e):
-                                pos_side_str = "Long" if order_side == "buy" else "Short"
-                                print(f"Retrying cancel with posSide={pos_side_str}")
-                                exchange.cancel_order(order['id'], symbol, {'posSide': pos_side_str})
-                            else:
-                                print(f"Error cancelling order: {e}")
+                        logger.warning(f"⚠️ Cancelling mismatched {order_side.upper()} {order_type} order for {symbol} (position side: {current_side})")
+                        batch.cancel(order)
 
             except Exception as e:
-                print(f"Error handling {symbol}: {e}")
+                logger.error(f"Error handling {symbol}: {e}")
+
+        failed = batch.send_cancels()
+        if failed:
+            logger.warning(f"⚠️ Orphan orders left in place for: {', '.join(sorted(failed))}")
 
     except Exception as e:
-        print(f"Global error in cancel_orphan_orders: {e}")
+        logger.error(f"Global error in cancel_orphan_orders: {e}")
 
         
-def monitor_position_and_reenter(exchange, symbol, position):
-    try:
-        if position:
-            # print(json.dumps(position, indent = 4))
-            liquidation_price = float(position.get('liquidationPrice') or 0)
-            entry_price = float(position.get('entryPrice') or 0)
-            mark_price = float(position.get('markPrice') or 0)
-            contracts = float(position.get('contracts') or 0)
-            leverage = float(position.get("leverage") or 1)
-            notional = float(position.get('notional') or 0)
-            price_precision_val = exchange.markets[symbol]['precision']['price']
-            price_sig_digits = count_sig_digits(price_precision_val)
-            amount_precision_val = exchange.markets[symbol]['precision']['amount']
-            amount_sig_digits = count_sig_digits(amount_precision_val)
-            side = position.get('side').lower()  # typically 'long' or 'short'
-            fromPercnt = 0.1  #20%
-            if not liquidation_price or not entry_price or not mark_price:
-                return  # Skip if essential data is missing
-            # Calculate how far the price has moved toward liquidation.
-            if side == 'long':
-                closeness = 1 - (abs(mark_price - liquidation_price) / abs(entry_price - liquidation_price))
-            else:  # short
-                closeness = 1 - (abs(mark_price - liquidation_price) / abs(entry_price - liquidation_price))
-            print(f"\n--- {symbol} ---")
-            print(f"Side: {side}")
-            print(f"Entry Price: {entry_price}")
-            print(f"Mark Price: {mark_price}")
-            print(f"Liquidation Price: {liquidation_price}")
-            print(f"Closeness to Liquidation: {closeness * 100:.2f}%")
-            # Fetch all open orders
-            open_orders = exchange.fetchOpenOrders(symbol)
-            side_str = 'buy' if side == 'long' else 'sell' # smae side
-            has_same_side_limit = any(
-                o['type'] == 'limit' and o['side'] == side_str for o in open_orders
-            )
-            if has_same_side_limit:
-                print("Same-side limit order already exists. Doing nothing.")
-                return
-            print("Open Orders: ", open_orders)
-            # call on rentry function
-            order_side = 'sell' if side == 'short' else 'buy'
-            order_price = mark_price
-            double_notional = notional * 2
-            order_amount = double_notional / mark_price
-            order_amount = round_to_sig_figs(order_amount, amount_sig_digits)
-            order_type = 'limit'
-            triggerPrice = calculateLiquidationTargPrice(entry_price, liquidation_price, fromPercnt, price_sig_digits)
-            print("Trigger Price: ", triggerPrice, " and Order Amount: ", order_amount)
-            reEnterTrade(exchange, symbol, order_side, triggerPrice, order_amount, order_type)
-            # Trigger re-entry logic if close to liquidation
-            if closeness >= 0.8:
-                print("⚠️  Mark price is 80% close to liquidation! Considering re-entry...")
-            else:
-                print("✅ Not close enough to liquidation for re-entry.")
-        else:
-            print(f"No open{symbol} positions found.")
-    except ccxt.ExchangeError as e:
-        print(f"Exchange error: {e}")
-    except KeyError as ke:
-        print(f"Missing key: {ke}")
-    time.sleep(1)
+def monitor_position_and_reenter(exchange, symbol, position, open_orders=None):
+    if not position:
+        logger.info(f"No open{symbol} positions found.")
+        return
+    # Read open orders from the tick snapshot, fetching only if it doesn't cover this symbol
+    if open_orders is None or not open_orders.has_symbol(symbol):
+        open_orders = OpenOrdersSnapshot.fetch(exchange, [symbol])
+    frame = build_position_frame([position], open_orders)
+    execute_actions(exchange, plan_actions(frame, trailing=False))
 
 TRAILING_FOLDER = "trailProfit"
 TRAILING_ORDER_FOLDER = "tradeOrder"
 
+# Trailing state backend: 'sqlite' (default) or the legacy per-symbol 'json' files
+TRAILING_BACKEND = os.getenv('TRAILING_BACKEND', 'sqlite')
+TRAILING_DB_FILE = os.getenv('TRAILING_DB_FILE', 'trailing_state.db')
+
+# Append-only journal of order placements, replayed on startup
+ORDER_JOURNAL_FILE = os.getenv('ORDER_JOURNAL_FILE', 'order_journal.jsonl')
+ORDER_JOURNAL_MAX_BYTES = int(os.getenv('ORDER_JOURNAL_MAX_BYTES', str(1024 * 1024)))
+
 # Ensure base folders exist
-os.makedirs(os.path.join(TRAILING_FOLDER, "buy"), exist_ok=True)
-os.makedirs(os.path.join(TRAILING_FOLDER, "sell"), exist_ok=True)
 os.makedirs(TRAILING_ORDER_FOLDER, exist_ok=True)
 
 
 def safe_filename(symbol):
     return symbol.replace('/', '_').replace(':', '_')
 
+def filename_to_symbol(filename):
+    # Example input: "JELLYJELLY_USDT_USDT.json"
+    parts = filename.replace(".json", "").split("_")
+    if len(parts) < 3:
+        return None
+    base = parts[0]  # e.g. "JELLYJELLY"
+    quote = parts[1]  # e.g. "USDT"
+    return f"{base}/{quote}:USDT"
+
+
+class JsonTrailingStore:
+    """One JSON file per symbol under trailProfit/buy and trailProfit/sell.
+
+    Entries are addressed by (side, key) where side is 'buy' or 'sell' and key
+    is the file name without the .json suffix.
+    """
+
+    def __init__(self, folder=TRAILING_FOLDER):
+        self.folder = folder
+        for subfolder in ['buy', 'sell']:
+            os.makedirs(os.path.join(folder, subfolder), exist_ok=True)
+
+    def key_for(self, symbol):
+        return safe_filename(symbol)
+
+    def symbol_for(self, key):
+        return filename_to_symbol(f"{key}.json")
+
+    def path(self, side, key):
+        return os.path.join(self.folder, side, f"{key}.json")
+
+    def load(self, symbol, side):
+        return self.load_key(side, self.key_for(symbol))
+
+    def load_key(self, side, key):
+        try:
+            with open(self.path(side, key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, symbol, data, side):
+        self.save_key(side, self.key_for(symbol), data)
+
+    def save_key(self, side, key, data):
+        filepath = self.path(side, key)
+        # Write to a temp file and swap it in so a crash never leaves half a file
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, filepath)
+
+    def delete_key(self, side, key):
+        try:
+            os.remove(self.path(side, key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def entries(self):
+        for side in ['buy', 'sell']:
+            try:
+                for fname in os.listdir(os.path.join(self.folder, side)):
+                    if fname.endswith(".json"):
+                        yield side, fname[:-len(".json")]
+            except FileNotFoundError:
+                continue
+
+    @contextmanager
+    def batch(self):
+        yield
+
+    def sync(self):
+        os.sync()
+
+    def close(self):
+        pass
+
+
+class SqliteTrailingStore:
+    """Trailing state in a single SQLite database in WAL mode, keyed by (symbol, side)."""
+
+    def __init__(self, path=TRAILING_DB_FILE):
+        self.path = path
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS trailing_state ("
+            " symbol TEXT NOT NULL,"
+            " side TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (symbol, side))"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def key_for(self, symbol):
+        return symbol
+
+    def symbol_for(self, key):
+        return key
+
+    def load(self, symbol, side):
+        return self.load_key(side, symbol)
+
+    def load_key(self, side, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM trailing_state WHERE symbol = ? AND side = ?", (key, side)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, symbol, data, side):
+        self.save_key(side, symbol, data)
+
+    def save_key(self, side, key, data):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO trailing_state (symbol, side, data, updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (symbol, side) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (key, side, json.dumps(data), time.time()),
+            )
+
+    def delete_key(self, side, key):
+        with self.lock:
+            cursor = self.conn.execute(
+                "DELETE FROM trailing_state WHERE symbol = ? AND side = ?", (key, side)
+            )
+        return cursor.rowcount > 0
+
+    def entries(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT side, symbol FROM trailing_state").fetchall()
+        return [(side, symbol) for side, symbol in rows]
+
+    @contextmanager
+    def batch(self):
+        # Every write made while a batch is open, from any thread, shares one
+        # transaction. It is committed even on error, since the orders it
+        # records have already been placed.
+        with self.lock:
+            self.batch_depth += 1
+            if self.batch_depth == 1:
+                self.conn.execute("BEGIN")
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.conn.execute("COMMIT")
+
+    def migrate_from_json(self, json_store):
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+                return 0
+            migrated = 0
+            with self.batch():
+                for side, key in json_store.entries():
+                    data = json_store.load_key(side, key)
+                    symbol = (data or {}).get('symbol') or json_store.symbol_for(key)
+                    if data is None or not symbol:
+                        continue
+                    self.save(symbol, data, side)
+                    migrated += 1
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from_json', ?)", (str(time.time()),))
+        if migrated:
+            logger.info(f"📦 Migrated {migrated} trailing files from {json_store.folder} into {self.path}")
+        return migrated
+
+    def sync(self):
+        # With synchronous=NORMAL only a checkpoint guarantees the WAL is on disk
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class CachedTrailingStore:
+    """Write-behind cache in front of a trailing store backend.
+
+    Everything is loaded once at startup and served from memory. Writes only
+    mark entries dirty; flush() persists them in one backend batch and is
+    called at the end of every tick, close() also syncs to disk.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.data = {}
+        self.dirty = set()
+        # Exact key -> symbol map, so keys never have to be parsed back into symbols
+        self.symbols = {}
+        for side, key in backend.entries():
+            data = backend.load_key(side, key)
+            if data is not None:
+                self.data[(side, key)] = data
+                if data.get('symbol'):
+                    self.symbols[key] = data['symbol']
+        logger.info(f"📦 Loaded {len(self.data)} trailing entries into memory")
+
+    def key_for(self, symbol):
+        key = self.backend.key_for(symbol)
+        self.symbols.setdefault(key, symbol)
+        return key
+
+    def symbol_for(self, key):
+        # Entries saved before the symbol was recorded fall back to the backend's guess
+        return self.symbols.get(key) or self.backend.symbol_for(key)
+
+    def load(self, symbol, side):
+        return self.load_key(side, self.key_for(symbol))
+
+    def load_key(self, side, key):
+        with self.lock:
+            data = self.data.get((side, key))
+        # Callers mutate what they load before saving it back
+        return dict(data) if data is not None else None
+
+    def save(self, symbol, data, side):
+        self.save_key(side, self.key_for(symbol), data)
+
+    def save_key(self, side, key, data):
+        with self.lock:
+            self.data[(side, key)] = dict(data)
+            self.dirty.add((side, key))
+
+    def delete_key(self, side, key):
+        with self.lock:
+            existed = self.data.pop((side, key), None) is not None
+            if existed:
+                self.dirty.add((side, key))
+        return existed
+
+    def entries(self):
+        with self.lock:
+            return list(self.data)
+
+    @contextmanager
+    def batch(self):
+        yield
+
+    def flush(self):
+        with self.lock:
+            pending = [(entry, self.data.get(entry)) for entry in self.dirty]
+            self.dirty = set()
+        if not pending:
+            return
+        try:
+            with self.backend.batch():
+                for (side, key), data in pending:
+                    if data is None:
+                        self.backend.delete_key(side, key)
+                    else:
+                        self.backend.save_key(side, key, data)
+        except Exception:
+            # Keep them dirty so the next flush retries
+            with self.lock:
+                self.dirty.update(entry for entry, _ in pending)
+            raise
+
+    def sync(self):
+        self.flush()
+        self.backend.sync()
+
+    def close(self):
+        self.sync()
+        self.backend.close()
+
+
+def create_trailing_store(backend=TRAILING_BACKEND, state_dir="."):
+    if backend == 'json':
+        store = JsonTrailingStore(os.path.join(state_dir, TRAILING_FOLDER))
+    elif backend == 'sqlite':
+        store = SqliteTrailingStore(os.path.join(state_dir, TRAILING_DB_FILE))
+        store.migrate_from_json(JsonTrailingStore(os.path.join(state_dir, TRAILING_FOLDER)))
+    else:
+        raise ValueError(f"Unknown TRAILING_BACKEND: {backend}")
+    return CachedTrailingStore(store)
+
+
+trailing_store = None
+
+
+class OrderJournal:
+    """Append-only record of order placements, so a crash between placing an
+    order and saving its id into the trailing state loses nothing.
+
+    Every placement gets a client order id and an 'intent' record before the
+    request, then a 'done' (with the exchange order id) or 'failed' record.
+    Records reach the OS on every write, which survives a process crash; the
+    fsync is batched into the 'checkpoint' appended after each trailing flush.
+    Everything after the last checkpoint is what recover_from_journal()
+    replays on startup.
+    """
+
+    def __init__(self, path=ORDER_JOURNAL_FILE, max_bytes=ORDER_JOURNAL_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.seq = self.last_seq()
+        self.checkpointed = self.seq
+        self.ids = itertools.count()
+        # Unique per process start, so ids never repeat across restarts
+        self.prefix = f"cs{int(time.time() * 1000):x}"
+        self.dirty = False
+        self.file = open(path, "a", encoding="utf-8")
+
+    def last_seq(self):
+        return max((record.get('seq', 0) for record in self.records()), default=0)
+
+    def records(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A torn last line from a crash mid-write
+                continue
+        return records
+
+    def client_order_id(self):
+        return f"{self.prefix}-{next(self.ids)}"
+
+    def append(self, record):
+        with self.lock:
+            self.seq += 1
+            self.file.write(json.dumps({'seq': self.seq, 'ts': time.time(), **record}, separators=(',', ':')) + "\n")
+            self.file.flush()
+            self.dirty = True
+            return self.seq
+
+    def intent(self, cid, kind, symbol, side, **details):
+        return self.append({'op': 'intent', 'cid': cid, 'kind': kind, 'symbol': symbol, 'side': side, **details})
+
+    def done(self, cid, order_id):
+        return self.append({'op': 'done', 'cid': cid, 'order_id': order_id})
+
+    def failed(self, cid, error):
+        return self.append({'op': 'failed', 'cid': cid, 'error': str(error)[:200]})
+
+    def sync(self):
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def checkpoint(self, upto):
+        """Marks every record up to seq upto as covered by persisted trailing state."""
+        with self.lock:
+            if upto <= self.checkpointed:
+                return
+            idle = self.seq == upto
+        if idle and os.path.getsize(self.path) > self.max_bytes:
+            self.reset()
+            return
+        self.checkpointed = self.append({'op': 'checkpoint', 'upto': upto})
+        self.sync()
+
+    def pending(self):
+        """Placements with records after the last checkpoint, as cid -> merged record, oldest first."""
+        records = self.records()
+        upto = max((r['upto'] for r in records if r.get('op') == 'checkpoint'), default=0)
+        recent = {r['cid'] for r in records if r.get('cid') and r.get('seq', 0) > upto}
+        entries = {}
+        for record in records:
+            cid = record.get('cid')
+            if cid in recent:
+                entries.setdefault(cid, {}).update({k: v for k, v in record.items() if k not in ('op', 'seq', 'ts')})
+                entries[cid].setdefault('ops', []).append(record['op'])
+        return {cid: entry for cid, entry in entries.items() if 'failed' not in entry['ops']}
+
+    def reset(self):
+        with self.lock:
+            self.file.close()
+            tmp_path = f"{self.path}.tmp"
+            open(tmp_path, "w").close()
+            os.replace(tmp_path, self.path)
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.dirty = False
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            self.file.close()
+
+
+order_journal = None
+
+
 def load_trailing_data(symbol, side):
-    filename = f"{safe_filename(symbol)}.json"
     subfolder = 'buy' if side == 'long' else 'sell'
-    filepath = os.path.join(TRAILING_FOLDER, subfolder, filename)
-    if os.path.exists(filepath):
-        with open(filepath, "r") as f:
-            return json.load(f)
-    return None
+    return trailing_store.load(symbol, subfolder)
 
 
 def save_trailing_data(symbol, data, side):
-    filename = f"{safe_filename(symbol)}.json"
     subfolder = 'buy' if side == 'long' else 'sell'
-    filepath = os.path.join(TRAILING_FOLDER, subfolder, filename)
-    data['side'] = 'buy' if side == 'long' else 'sell'
-    with open(filepath, "w") as f:
-        json.dump(data, f, indent=4)
+    data['side'] = subfolder
+    data['symbol'] = symbol
+    trailing_store.save(symbol, data, subfolder)
 
 
 def delete_trailing_data(symbol):
-    filename = f"{safe_filename(symbol)}.json"
     deleted = False
+    key = trailing_store.key_for(symbol)
     for subfolder in ['buy', 'sell']:
-        filepath = os.path.join(TRAILING_FOLDER, subfolder, filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"🗑️ Deleted trailing data for {symbol} from {subfolder} folder")
+        if trailing_store.delete_key(subfolder, key):
+            logger.info(f"🗑️ Deleted trailing data for {symbol} from {subfolder} folder")
             deleted = True
     if not deleted:
-        print(f"⚠️ No trailing data found to delete for {symbol}")
+        logger.warning(f"⚠️ No trailing data found to delete for {symbol}")
     return deleted
 
 
+def flush_trailing_data():
+    try:
+        upto = order_journal.seq
+        trailing_store.flush()
+        order_journal.checkpoint(upto)
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to flush trailing data: {e}")
+
+
 def reset_trailing_data(symbol=None):
     if symbol:
-        filepath = os.path.join(TRAILING_FOLDER, f"{symbol.replace('/', '_')}.json")
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"🧹 Trailing data reset for {symbol}. File deleted.")
+        if delete_trailing_data(symbol):
+            logger.info(f"🧹 Trailing data reset for {symbol}.")
         else:
-            print(f"🧹 No trailing data file found for {symbol}. Nothing to delete.")
+            logger.info(f"🧹 No trailing data found for {symbol}. Nothing to delete.")
     else:
-        for filename in os.listdir(TRAILING_FOLDER):
-            filepath = os.path.join(TRAILING_FOLDER, filename)
-            os.remove(filepath)
-        print("🧹 All trailing data reset. All files deleted.")
+        with trailing_store.batch():
+            for side, key in list(trailing_store.entries()):
+                trailing_store.delete_key(side, key)
+        logger.info("🧹 All trailing data reset.")
+
+def cancel_stop_order(exchange, symbol, side, order_id):
+    pos_side = 'Long' if side == 'long' else 'Short'
+    try:
+        with_position_mode(symbol, pos_side, lambda mode_params: exchange.cancel_order(
+            order_id, symbol=symbol, params=mode_params
+        ))
+        logger.info(f"❌ Canceled previous stop-loss {order_id}")
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to cancel stop-loss: {e}")
+
+
+def place_stop_order(exchange, symbol, side, contracts, stop_price, client_order_id=None):
+    pos_side = 'Long' if side == 'long' else 'Short'
+
+    def create(mode_params):
+        params = {
+            'stopPx': stop_price,
+            'triggerType': 'ByLastPrice',
+            'triggerDirection': 1 if side == 'long' else 2,  # 🔥 This line is required
+            'closeOnTrigger': True,
+            'reduceOnly': True,
+            'timeInForce': 'GoodTillCancel',
+            **mode_params
+        }
+        if mode_params:
+            params['positionIdx'] = 1 if side == 'long' else 2
+        if client_order_id:
+            params['clientOrderId'] = client_order_id
+        return exchange.create_order(
+            symbol=symbol,
+            type='stop',
+            side='sell' if side == 'long' else 'buy',
+            amount=contracts,
+            price=None,
+            params=params
+        )
+
+    try:
+        # Unknown symbols try hedge mode first, as stop placement always has
+        order = with_position_mode(symbol, pos_side, create, default='hedge')
+        logger.info(f"✅ Placed new stop-loss at {stop_price:.4f} for {symbol} ({position_modes.get(symbol)} mode)")
+        return order
+    except Exception as e:
+        logger.error(f"❌ Failed to place stop-loss for {symbol}: {e}")
+        return None
+
+
+def update_stop_order(exchange, symbol, side, contracts, stop_price, order_id, client_order_id=None):
+    """Moves a stop-loss without ever leaving the position unprotected.
+
+    Amends the existing order in place when the exchange supports it,
+    otherwise places the new stop first and only then cancels the old one.
+    """
+    if order_id and exchange.has.get('editOrder'):
+        pos_side = 'Long' if side == 'long' else 'Short'
+        try:
+            order = with_position_mode(symbol, pos_side, lambda mode_params: exchange.edit_order(
+                order_id,
+                symbol,
+                'stop',
+                'sell' if side == 'long' else 'buy',
+                contracts,
+                None,
+                params={'stopPx': stop_price, **mode_params}
+            ), default='hedge')
+            logger.info(f"✏️ Amended stop-loss {order_id} to {stop_price:.4f} for {symbol}")
+            return order if order.get('id') else {**order, 'id': order_id}
+        except Exception as e:
+            # Typically the old stop already triggered or was cancelled
+            RETRIES.inc(code=error_code(e))
+            logger.warning(f"⚠️ Amending stop-loss {order_id} failed: {e} — placing a new one")
+
+    order = place_stop_order(exchange, symbol, side, contracts, stop_price, client_order_id)
+    if order and order_id:
+        cancel_stop_order(exchange, symbol, side, order_id)
+    return order
+
 
 # The main trailing stop logic now loads/saves per symbol
 def trailing_stop_logic(exchange, position, breath_stop, breath_threshold):
-    symbol = position.get('symbol')
-    entry_price = float(position.get('entryPrice') or 0)
-    mark_price = float(position.get('markPrice') or 0)
-    side = position.get('side', '').lower()
-    leverage = float(position.get("leverage") or 1)
-    contracts = float(position.get('contracts') or 0)
-
-    if not entry_price or not mark_price or side not in ['long', 'short'] or contracts <= 0:
-        return
+    frame = build_position_frame([position])
+    execute_actions(exchange, plan_actions(frame, breath_stop, breath_threshold, reentry=False))
 
 
-    trailing_data = load_trailing_data(symbol, side) or {
-        'threshold': 0.10,
-        'profit_target_distance': 0.06
-    }
+DEFAULT_TRAILING_DATA = {
+    'threshold': DEFAULT_THRESHOLD,
+    'profit_target_distance': DEFAULT_PROFIT_TARGET_DISTANCE
+}
+LIQUIDATION_WARNING = 0.8
 
-    threshold = trailing_data['threshold']
-    profit_target_distance = trailing_data['profit_target_distance']
-    order_id = trailing_data.get('orderId')
-
-    change = (mark_price - entry_price) / entry_price if side == 'long' else (entry_price - mark_price) / entry_price
-    profit_distance = change * leverage
-
-    print("Leverage: ", leverage)
-    unrealized_pnl = (mark_price - entry_price) * contracts if side == 'long' else (entry_price - mark_price) * contracts
-    realized_pnl = float(position["info"].get('curTermRealisedPnlRv') or 0)
-    addUnreRea = unrealized_pnl + realized_pnl
-    # # Round to 4 significant figures inline
-    # unrealized_pnl_rounded = round_to_sig_figs(unrealized_pnl, 4)
-    # realized_pnl_rounded = round_to_sig_figs(realized_pnl, 4)
-
-    print("\n\nUnrealized PnL:", unrealized_pnl)
-    print("Realized PnL:", realized_pnl)
-    print(f"Add unrpnl and reapnl: {addUnreRea}")
-    print("distance entry - last price (for profit):", profit_distance)
-    
-    if addUnreRea <= 0.001:
-        if order_id:
-            try:
-                # Try canceling without posSide param first (one-way mode)
-                exchange.cancel_order(order_id, symbol=symbol)
-                print(f"❌ Canceled previous stop-loss {order_id} without posSide")
-            except Exception as e:
-                error_msg = str(e)
-                # Check if error is related to inconsistent position mode
-                if "TE_ERR_INCONSISTENT_POS_MODE" in error_msg:
-                    try:
-                        # Retry with posSide param (hedge mode)
-                        params = {'posSide': 'Long' if side == 'long' else 'Short'}
-                        exchange.cancel_order(order_id, symbol=symbol, params=params)
-                        print(f"❌ Canceled previous stop-loss {order_id} with posSide param")
-                    except Exception as e2:
-                        print(f"⚠️ Failed to cancel stop-loss even with posSide: {e2}")
-                else:
-                    print(f"⚠️ Failed to cancel stop-loss: {e}")
-                    
+
+def build_position_frame(positions, open_orders=None):
+    """One row per Position with every column the risk pass needs."""
+    rows = []
+    for position in positions:
+        symbol = position.symbol
+        side = position.side
+        trailing_data = load_trailing_data(symbol, side) if side in ['long', 'short'] else None
+        trailing = trailing_data or DEFAULT_TRAILING_DATA
+        try:
+            symbol_info = market_cache.symbol_info(symbol)
+            has_market_info = True
+        except KeyError:
+            # Rounding to 0 significant digits would turn the re-entry price into 0 or a power of ten
+            logger.warning(f"Missing market info for {symbol}, skipping its re-entry")
+            symbol_info = {'price_sig_digits': 0, 'amount_sig_digits': 0}
+            has_market_info = False
+        side_str = 'buy' if side == 'long' else 'sell'
+        rows.append({
+            'symbol': symbol,
+            'side': side,
+            'entry_price': position.entry_price,
+            'mark_price': position.mark_price,
+            'liquidation_price': position.liquidation_price,
+            'contracts': position.contracts,
+            'leverage': position.leverage,
+            'notional': position.notional,
+            'realized_pnl': position.realized_pnl,
+            'threshold': trailing['threshold'],
+            'profit_target_distance': trailing['profit_target_distance'],
+            'order_id': trailing.get('orderId') or '',
+            'trailing_data': trailing_data,
+            'price_sig_digits': symbol_info['price_sig_digits'],
+            'amount_sig_digits': symbol_info['amount_sig_digits'],
+            'has_same_side_limit': bool(open_orders and open_orders.orders(symbol, side_str, 'limit')),
+            'has_market_info': has_market_info,
+        })
+    return pd.DataFrame(rows, columns=[
+        'symbol', 'side', 'entry_price', 'mark_price', 'liquidation_price', 'contracts',
+        'leverage', 'notional', 'realized_pnl', 'threshold', 'profit_target_distance',
+        'order_id', 'trailing_data', 'price_sig_digits', 'amount_sig_digits', 'has_same_side_limit',
+        'has_market_info',
+    ])
+
+
+def compute_risk(frame):
+    """Adds the trailing and liquidation columns to a position frame, as array operations."""
+    entry = frame['entry_price'].to_numpy()
+    mark = frame['mark_price'].to_numpy()
+    liq = frame['liquidation_price'].to_numpy()
+    contracts = frame['contracts'].to_numpy()
+    leverage = frame['leverage'].to_numpy()
+    is_long = (frame['side'] == 'long').to_numpy()
+    is_short = (frame['side'] == 'short').to_numpy()
+
+    (
+        frame['profit_distance'],
+        frame['unrealized_pnl'],
+        frame['total_pnl'],
+        frame['new_stop_price'],
+        frame['losing'],
+        frame['move'],
+    ) = trailing_signals(
+        is_long, entry, mark, contracts, leverage,
+        frame['realized_pnl'].to_numpy(),
+        frame['threshold'].to_numpy(),
+        frame['profit_target_distance'].to_numpy(),
+    )
+    frame['closeness'] = liquidation_closeness(entry, mark, liq)
+    frame['reentry_price_raw'], frame['reentry_amount_raw'] = reentry_levels(
+        entry, liq, mark, frame['notional'].to_numpy()
+    )
+
+    frame['tradable'] = (entry > 0) & (mark > 0) & (is_long | is_short) & (contracts > 0)
+    return frame
+
+
+def plan_actions(frame, breath_stop=0.10, breath_threshold=0.10, trailing=True, reentry=True):
+    """Turns a position frame into the exchange actions this tick needs.
+
+    Returns dicts with an 'action' of 'cancel_stop' (position back in the red,
+    drop its trailing stop), 'move_stop' or 'reenter'. Symbols with nothing to
+    do produce no action and get no exchange call.
+    """
+    if frame.empty:
+        return []
+    frame = compute_risk(frame)
+    tradable = frame['tradable'].to_numpy()
+    losing = frame['losing'].to_numpy()
+    has_trailing = frame['trailing_data'].notna().to_numpy()
+
+    cancel_mask = np.zeros(len(frame), dtype=bool)
+    move_mask = np.zeros(len(frame), dtype=bool)
+    reenter_mask = np.zeros(len(frame), dtype=bool)
+    if trailing:
+        cancel_mask = tradable & losing & has_trailing
+        move_mask = tradable & frame['move'].to_numpy()
+    if reentry:
+        reenter_mask = (
+            (frame['contracts'] > 0).to_numpy()
+            & (frame['liquidation_price'] > 0).to_numpy()
+            & (frame['entry_price'] > 0).to_numpy()
+            & (frame['mark_price'] > 0).to_numpy()
+            & ~frame['has_same_side_limit'].to_numpy(dtype=bool)
+            & frame['has_market_info'].to_numpy(dtype=bool)
+        )
+
+    actions = []
+    for row in frame[cancel_mask | move_mask | reenter_mask].itertuples():
+        i = row.Index
+        if cancel_mask[i]:
+            actions.append({
+                'action': 'cancel_stop',
+                'symbol': row.symbol,
+                'side': row.side,
+                'order_id': row.order_id or None,
+            })
+        if move_mask[i]:
+            trailing_data = dict(row.trailing_data if has_trailing[i] else DEFAULT_TRAILING_DATA)
+            trailing_data['profit_target_distance'] = row.profit_target_distance + breath_threshold
+            trailing_data['threshold'] = row.threshold + breath_threshold
+            trailing_data['order_updated'] = True
+            actions.append({
+                'action': 'move_stop',
+                'symbol': row.symbol,
+                'side': row.side,
+                'contracts': row.contracts,
+                'stop_price': row.new_stop_price,
+                'order_id': row.order_id or None,
+                'profit_distance': row.profit_distance,
+                'profit_target_distance': row.profit_target_distance,
+                'trailing_data': trailing_data,
+            })
+        if reenter_mask[i]:
+            actions.append({
+                'action': 'reenter',
+                'symbol': row.symbol,
+                'side': row.side,
+                'order_side': 'buy' if row.side == 'long' else 'sell',
+                'price': round_to_sig_figs(row.reentry_price_raw, row.price_sig_digits),
+                'amount': round_to_sig_figs(row.reentry_amount_raw, row.amount_sig_digits),
+                'closeness': row.closeness,
+                'leverage': row.leverage,
+            })
+    return actions
+
+
+def execute_action(exchange, action):
+    symbol, side = action['symbol'], action['side']
+    if action['action'] == 'cancel_stop':
+        if action['order_id']:
+            cancel_stop_order(exchange, symbol, side, action['order_id'])
         delete_trailing_data(symbol)
-        return
+        STOP_CANCELS.inc()
+
+    elif action['action'] == 'move_stop':
+        logger.info(f"📈 {side.capitalize()} position on {symbol} is {action['profit_distance'] * 100:.2f}% in profit (leveraged)")
+        logger.info(f"🔄 Moving stop-loss to {round(action['profit_target_distance'] * 100, 2)}%, at price {action['stop_price']:.4f}",
+                    extra={'symbol': symbol, 'side': side, 'stop_price': action['stop_price']})
+        # Journaled first, so a crash before the trailing data is saved cannot leave an untracked stop
+        cid = order_journal.client_order_id()
+        order_journal.intent(cid, 'stop', symbol, side, replaces=action['order_id'], trailing=action['trailing_data'])
+        order = update_stop_order(exchange, symbol, side, action['contracts'], action['stop_price'], action['order_id'], cid)
+        STOP_MOVES.inc(result='moved' if order else 'failed')
+        # ✅ Save updated trailing data
+        if order:
+            order_journal.done(cid, order['id'])
+            trailing_data = action['trailing_data']
+            trailing_data['orderId'] = order['id']
+            save_trailing_data(symbol, trailing_data, side)
+        else:
+            order_journal.failed(cid, "stop-loss not placed")
+
+    elif action['action'] == 'reenter':
+        log_reentry(action)
+        reEnterTrade(exchange, symbol, action['order_side'], action['price'], action['amount'], 'limit', action['leverage'])
+
+
+def log_reentry(action):
+    symbol, side = action['symbol'], action['side']
+    logger.info(f"🔁 {symbol} {side}: closeness to liquidation {action['closeness'] * 100:.2f}%, "
+                f"re-entry {action['order_side']} {action['amount']} @ {action['price']}",
+                extra={'symbol': symbol, 'side': side, 'closeness': action['closeness']})
+    if action['closeness'] >= LIQUIDATION_WARNING:
+        logger.warning(f"⚠️  {symbol} mark price is {LIQUIDATION_WARNING:.0%} close to liquidation!")
+
+
+def place_reentries(exchange, actions):
+    """Places the re-entries of a tick through one OrderBatch; returns the symbols that failed."""
+    batch = OrderBatch(exchange)
+    queued = []
+    for action in actions:
+        log_reentry(action)
+        symbol = action['symbol']
+        estimated_cost = reserve_reentry(symbol, action['price'], action['amount'], action['leverage'])
+        if estimated_cost is None:
+            continue
+        pos_side = 'Long' if action['order_side'] == 'buy' else 'Short'
+        cid = journal_reentry(symbol, action['order_side'], action['price'], action['amount'])
+        batch.create(symbol, pos_side, reentry_order(symbol, action['order_side'], action['price'], action['amount'], 'limit', cid))
+        queued.append((action, estimated_cost, cid))
+
+    failed = []
+    for (action, estimated_cost, cid), result in zip(queued, batch.send_creates()):
+        if isinstance(result, Exception):
+            order_journal.failed(cid, result)
+            balance_cache.release(estimated_cost)
+            reentry_failed(action['symbol'], result)
+            failed.append(action['symbol'])
+        else:
+            order_journal.done(cid, result.get('id'))
+            active_universe.note_order(action['symbol'])
+            REENTRIES.inc(result='placed')
+            logger.info(f"✅ Re-entry order placed: {action['order_side']} {action['amount']} @ {action['price']}")
+    return failed
 
-    if profit_distance >= threshold:
-        print(f"📈 Hello! {side.capitalize()} position on {symbol} is up {round(change * 100, 2)}%")
-        new_stop_price = entry_price * (1 + profit_target_distance / leverage) if side == 'long' else entry_price * (1 - profit_target_distance / leverage)
 
-        if (side == 'long' and new_stop_price <= entry_price) or (side == 'short' and new_stop_price >= entry_price):
-            print(f"New stop loss @ {new_stop_price} is not valid relative to entry price @ {entry_price}")
-            return
+def execute_actions(exchange, actions):
+    """Runs actions in order; returns the symbols whose actions raised."""
+    failed = []
+    for action in actions:
+        try:
+            reentry = action['action'] == 'reenter'
+            with tick_stats.stage('reentry' if reentry else 'trailing'), \
+                    request_priority(PRIORITY_REENTRY if reentry else PRIORITY_STOP):
+                execute_action(exchange, action)
+        except ccxt.ExchangeError as e:
+            logger.error(f"Exchange error on {action['action']} for {action['symbol']}: {e}")
+            failed.append(action['symbol'])
+        except Exception as e:
+            logger.exception(f"Error on {action['action']} for {action['symbol']}: {e}")
+            failed.append(action['symbol'])
+    return failed
 
-        print(f"🔄 Moving stop-loss to {round(profit_target_distance * 100, 2)}%, at price {new_stop_price:.4f}")
 
-        # ✅ Cancel old order if it exists
-        if order_id:
-            try:
-                # Try canceling without posSide param first (one-way mode)
-                exchange.cancel_order(order_id, symbol=symbol)
-                print(f"❌ Canceled previous stop-loss {order_id} without posSide")
-            except Exception as e:
-                error_msg = str(e)
-                # Check if error is related to inconsistent position mode
-                if "TE_ERR_INCONSISTENT_POS_MODE" in error_msg:
-                    try:
-                        # Retry with posSide param (hedge mode)
-                        params = {'posSide': 'Long' if side == 'long' else 'Short'}
-                        exchange.cancel_order(order_id, symbol=symbol, params=params)
-                        print(f"❌ Canceled previous stop-loss {order_id} with posSide param")
-                    except Exception as e2:
-                        print(f"⚠️ Failed to cancel stop-loss even with posSide: {e2}")
+def open_position_entries(positions):
+    """(side folder, symbol) of every open position."""
+    return {
+        ('buy' if pos.side == 'long' else 'sell', pos.symbol)
+        for pos in positions
+        if pos.is_open
+    }
+
+
+class PositionCloseTracker:
+    """Remembers the previous tick's open positions to tell which ones just closed."""
+
+    def __init__(self):
+        self.previous = None
+
+    def update(self, positions):
+        """Returns (previous, current) open entries; previous is None on the first call."""
+        current = open_position_entries(positions)
+        previous, self.previous = self.previous, current
+        return previous, current
+
+
+position_closes = PositionCloseTracker()
+
+
+class ActiveUniverse:
+    """The symbols a tick needs to look at: open positions, working orders and trailing state.
+
+    Ticks fetch positions for these symbols only. An account-wide fetch runs
+    on the first tick and then every sweep_interval seconds to pick up
+    positions opened outside the bot or by a re-entry filling elsewhere.
+    """
+
+    def __init__(self, sweep_interval=UNIVERSE_SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        self.positions = set()
+        self.orders = set()
+        self.last_sweep = None
+
+    def symbols(self):
+        trailing = {trailing_store.symbol_for(key) for _, key in trailing_store.entries()}
+        with self.lock:
+            return (self.positions | self.orders | trailing) - {None}
+
+    def sweep_due(self):
+        return self.last_sweep is None or time.monotonic() - self.last_sweep >= self.sweep_interval
+
+    def fetch_positions(self, exchange, all_symbols):
+        """This tick's Positions: account-wide when a sweep is due, else only the active symbols."""
+        symbols = self.symbols()
+        if self.sweep_due() or not symbols:
+            positions = parse_positions(exchange.fetch_positions(params={'settle': 'USDT'}))
+            self.last_sweep = time.monotonic()
+            listed = set(all_symbols)
+            positions = [pos for pos in positions if pos.symbol in listed]
+        else:
+            positions = parse_positions(exchange.fetch_positions(symbols=sorted(symbols)))
+        with self.lock:
+            self.positions = {symbol for _, symbol in open_position_entries(positions)}
+        return positions
+
+    def order_symbols(self):
+        with self.lock:
+            return set(self.orders)
+
+    def note_order(self, symbol):
+        with self.lock:
+            self.orders.add(symbol)
+
+    def update_orders(self, open_orders):
+        """Takes the symbols with working orders from an open-orders snapshot."""
+        with self.lock:
+            for symbol in open_orders.symbols:
+                if open_orders.orders(symbol):
+                    self.orders.add(symbol)
                 else:
-                    print(f"⚠️ Failed to cancel stop-loss: {e}")
+                    self.orders.discard(symbol)
 
-        order_created = False
 
-        # ✅ Try creating stop-loss in hedge mode
-        try:
-            order = exchange.create_order(
-                symbol=symbol,
-                type='stop',
-                side='sell' if side == 'long' else 'buy',
-                amount=contracts,
-                price=None,
-                params={
-                    'stopPx': new_stop_price,
-                    'triggerType': 'ByLastPrice',
-                    'triggerDirection': 1 if side == 'long' else 2,  # 🔥 This line is required
-                    'positionIdx': 1 if side == 'long' else 2,
-                    'posSide': 'Long' if side == 'long' else 'Short',
-                    'closeOnTrigger': True,
-                    'reduceOnly': True,
-                    'timeInForce': 'GoodTillCancel',
-                }
-            )
-            print(f"✅ Placed new stop-loss at {new_stop_price:.4f} for {symbol}")
-            order_created = True
-        except Exception as e:
-            print(f"⚠️ Hedge mode failed: {e} — retrying in one-way mode")
+active_universe = ActiveUniverse()
 
-        # ✅ Fallback: one-way mode
-        if not order_created:
-            try:
-                order = exchange.create_order(
-                    symbol=symbol,
-                    type='stop',
-                    side='sell' if side == 'long' else 'buy',
-                    amount=contracts,
-                    price=None,
-                    params={
-                        'stopPx': new_stop_price,
-                        'triggerType': 'ByLastPrice',
-                        'triggerDirection': 1 if side == 'long' else 2,  # 🔥 This line is required
-                        'reduceOnly': True,
-                        'closeOnTrigger': True,
-                        'timeInForce': 'GoodTillCancel',
-                    }
-                )
-                print(f"✅ Placed stop-loss in one-way mode at {new_stop_price:.4f} for {symbol}")
-                order_created = True
-            except Exception as e2:
-                print(f"❌ Failed again (one-way mode): {e2}")
-                return
 
-        # ✅ Save updated trailing data
-        if order_created:
-            trailing_data['orderId'] = order['id']
-            trailing_data['profit_target_distance'] = profit_target_distance + breath_threshold
-            trailing_data['threshold'] = threshold + breath_threshold
-            trailing_data['order_updated'] = True
-            save_trailing_data(symbol, trailing_data, side)
+def cleanup_closed_trailing_files(exchange, symbols, positions=None):
+    """Drops trailing state and orphan limit orders of positions that closed since the last tick.
 
-def filename_to_symbol(filename):
-    # Example input: "JELLYJELLY_USDT_USDT.json"
-    parts = filename.replace(".json", "").split("_")
-    if len(parts) < 3:
-        return None
-    base = parts[0]  # e.g. "JELLYJELLY"
-    quote = parts[1]  # e.g. "USDT"
-    return f"{base}/{quote}:USDT"
+    positions is the tick's own snapshot; without it one is fetched. The
+    first call after a start checks every stored entry, later calls only the
+    positions that disappeared since the previous call.
+    """
+    if positions is None:
+        try:
+            positions = parse_positions(exchange.fetch_positions(symbols=symbols))
+        except Exception as e:
+            logger.error(f"❌ Failed to fetch positions for cleanup: {e}")
+            return
+
+    previous, current = position_closes.update(positions)
+    if previous is None:
+        stale = [
+            (side, key) for side, key in trailing_store.entries()
+            if (side, trailing_store.symbol_for(key)) not in current
+        ]
+        closed_symbols = {trailing_store.symbol_for(key) for _, key in stale}
+    else:
+        closed = previous - current
+        stale = [(side, trailing_store.key_for(symbol)) for side, symbol in closed]
+        closed_symbols = {symbol for _, symbol in closed}
 
+    with trailing_store.batch():
+        for side, key in stale:
+            if trailing_store.delete_key(side, key):
+                logger.info(f"🧹 Deleted stale trailing data: {side}/{trailing_store.symbol_for(key)}")
 
-def cleanup_closed_trailing_files(exchange, symbols):
+    # 🔁 Only look for orphan orders on symbols that just closed
+    closed_symbols.discard(None)
     try:
-        positionst = exchange.fetch_positions(symbols=symbols)
+        if closed_symbols:
+            cancel_orphan_orders(exchange, sorted(closed_symbols), 'limit', positions=positions)
     except Exception as e:
-        print("❌ Failed to fetch positions for cleanup:", e)
-        return
+        logger.warning(f"⚠️ Error while cancelling orphan orders during cleanup: {e}")
 
-    active = {
-        ('buy' if pos.get('side', '').lower() == 'long' else 'sell', f"{safe_filename(pos.get('symbol'))}.json")
-        for pos in positionst
-        if pos.get('contracts', 0) > 0 and pos.get('side', '').lower() in ['long', 'short']
-    }
-    
-    deleted_symbols = set()
 
-    for subfolder in ['buy', 'sell']:
-        path = os.path.join(TRAILING_FOLDER, subfolder)
-        try:
-            for fname in os.listdir(path):
-                if (subfolder, fname) not in active:
-                    os.remove(os.path.join(path, fname))
-                    print(f"🧹 Deleted stale trailing file: {subfolder}/{fname}")
-                    
-                    # 🔑 Add symbol to list of deleted ones
-                    symbol_name = filename_to_symbol(fname)
-                    if symbol_name:
-                        deleted_symbols.add(symbol_name)
-        except FileNotFoundError:
+def recover_from_journal(exchange, journal):
+    """Reconciles placements journaled after the last checkpoint with the open orders; returns the repairs made.
+
+    Run once on startup, before the first tick. For every symbol and side the
+    newest journaled stop that is still open is adopted into the trailing
+    state; older journaled stops and the stops they replaced are cancelled,
+    so a crash between placing a stop and saving its id never leaves two.
+    """
+    entries = journal.pending()
+    if not entries:
+        journal.reset()
+        return 0
+
+    symbols = sorted({entry['symbol'] for entry in entries.values()})
+    open_orders = OpenOrdersSnapshot.fetch(exchange, symbols)
+    by_client_id, by_id = {}, {}
+    for symbol in symbols:
+        for order in open_orders.orders(symbol):
+            by_id[order.id] = order
+            if order.client_order_id:
+                by_client_id[order.client_order_id] = order
+
+    stops = {}
+    for entry in entries.values():
+        if entry.get('kind') == 'stop' and entry['symbol'] in open_orders.symbols:
+            stops.setdefault((entry['symbol'], entry['side']), []).append(entry)
+
+    repairs = 0
+    for (symbol, side), group in stops.items():
+        live = [
+            (entry, by_client_id.get(entry['cid']) or by_id.get(entry.get('order_id')))
+            for entry in group
+        ]
+        live = [(entry, order) for entry, order in live if order]
+        if not live:
             continue
-        
-    # 🔁 Only cancel orphan orders for symbols whose trailing files were deleted
+        entry, kept = live[-1]
+        trailing_data = load_trailing_data(symbol, side)
+        if not trailing_data or trailing_data.get('orderId') != kept.id:
+            save_trailing_data(symbol, {**entry.get('trailing', {}), 'orderId': kept.id}, side)
+            logger.info(f"🩹 Adopted stop-loss {kept.id} for {symbol} {side} from the order journal")
+            repairs += 1
+        # Anything else the journal knows of is a stop this one replaced or duplicated
+        stale = {order.id for _, order in live} | {entry.get('replaces') for entry in group}
+        for order_id in stale - {kept.id, None}:
+            if order_id in by_id:
+                cancel_stop_order(exchange, symbol, side, order_id)
+                repairs += 1
+
     try:
-        if deleted_symbols:
-            cancel_orphan_orders(exchange, list(deleted_symbols), 'limit')
+        trailing_store.flush()
+        journal.reset()
     except Exception as e:
-        print(f"⚠️ Error while cancelling orphan orders during cleanup: {e}")
+        logger.warning(f"⚠️ Failed to persist journal recovery: {e}")
+    logger.info(f"📒 Replayed {len(entries)} journaled orders, {repairs} repairs")
+    return repairs
 
 
 cancel_queue = queue.Queue()
 
-def create_exchange():
-    return ccxt.phemex({
-        'apiKey': api_key,
-        'secret': secret,
-        'enableRateLimit': True,
-    })
+
+# Request priorities for the shared scheduler, most urgent first
+PRIORITY_STOP = 0        # placing, moving or dropping protective stops
+PRIORITY_REENTRY = 1     # re-entry limit orders
+PRIORITY_BACKGROUND = 2  # tick fetches, orphan cleanup and other reads
+PRIORITY_NAMES = {PRIORITY_STOP: 'stop', PRIORITY_REENTRY: 'reentry', PRIORITY_BACKGROUND: 'background'}
+
+request_priority_var = contextvars.ContextVar('request_priority', default=PRIORITY_BACKGROUND)
+
+
+@contextmanager
+def request_priority(priority):
+    """Exchange calls made inside the block queue at this priority."""
+    token = request_priority_var.set(priority)
+    try:
+        yield
+    finally:
+        request_priority_var.reset(token)
+
+
+# Phemex rate-limit groups as (requests, per seconds): contract trading and
+# position endpoints share one budget, market data and the rest another
+ENDPOINT_BUDGETS = {'contract': (500, 60), 'others': (100, 60)}
+
+# Endpoint -> (group, weight); anything not listed costs 1 from 'contract'.
+# The weights are ccxt's phemex cost table, used as is for clients without
+# one (MockPhemex); endpoint_costs() reads them from the live client.
+ENDPOINT_COSTS = {
+    'fetch_ticker': ('others', 5),
+    'fetch_tickers': ('others', 5),
+    # Markets from the v1 and v2 product lists, currencies from v2 again
+    'load_markets': ('others', 15),
+    'loadMarkets': ('others', 15),
+    'cancel_all_orders': ('contract', 3),
+    'private_delete_g_orders': ('contract', 1),
+}
+
+# Endpoint -> (group, the raw paths it requests as section/method/path in ccxt's api table)
+ENDPOINT_PATHS = {
+    'fetch_ticker': ('others', ['v2/get/md/v2/ticker/24hr']),
+    'fetch_tickers': ('others', ['v2/get/md/v2/ticker/24hr/all']),
+    'load_markets': ('others', ['v2/get/public/products', 'v1/get/exchange/public/products', 'v2/get/public/products']),
+    'loadMarkets': ('others', ['v2/get/public/products', 'v1/get/exchange/public/products', 'v2/get/public/products']),
+    'cancel_all_orders': ('contract', ['private/delete/g-orders/all']),
+    'private_delete_g_orders': ('contract', ['private/delete/g-orders']),
+}
+
+
+def api_cost(api, path):
+    """Cost of one raw endpoint in a ccxt api table, or None if the table doesn't list it."""
+    section, method, endpoint = path.split('/', 2)
+    entry = api.get(section, {}).get(method, {}).get(endpoint)
+    if isinstance(entry, dict):
+        return entry.get('cost', 1)
+    return entry
+
+
+def endpoint_costs(client):
+    """ENDPOINT_COSTS with the weights of the client's own api cost metadata, where it has them."""
+    costs = dict(ENDPOINT_COSTS)
+    api = getattr(client, 'api', None)
+    if not isinstance(api, dict):
+        return costs
+    for name, (group, paths) in ENDPOINT_PATHS.items():
+        weights = [api_cost(api, path) for path in paths]
+        if None not in weights:
+            costs[name] = (group, sum(weights))
+    return costs
+
+
+class TokenBucket:
+    """Refilling request budget; callers hold the scheduler's lock."""
+
+    def __init__(self, capacity, rate_per_sec):
+        self.capacity = capacity
+        self.rate = rate_per_sec
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, weight, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (weight - self.tokens) / self.rate)
+
+    def take(self, weight):
+        self.tokens -= weight
+
+
+class RequestScheduler:
+    """Priority queue in front of one exchange's REST budget.
+
+    Every call needs a slot from the overall request spacing (ccxt's
+    rateLimit) and weight from its endpoint group's budget. Waiting calls are
+    served strictly by priority, then arrival order, so a bulk cleanup scan
+    never holds up a stop-loss move. Identical reads already in flight are
+    coalesced into one request.
+    """
+
+    def __init__(self, rate_per_sec, budgets=ENDPOINT_BUDGETS, costs=ENDPOINT_COSTS):
+        self.cond = threading.Condition()
+        self.costs = costs
+        self.spacing = TokenBucket(1, rate_per_sec)
+        self.buckets = {
+            group: TokenBucket(limit, limit / period) for group, (limit, period) in budgets.items()
+        }
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.cond:
+            self.max_depth = len(self.waiting)
+            self.coalesced = 0
+            self.waits = {priority: [0, 0.0, 0.0] for priority in PRIORITY_NAMES}  # count, total, max
+
+    def acquire(self, endpoint, priority):
+        group, weight = self.costs.get(endpoint, ('contract', 1))
+        bucket = self.buckets.get(group) or self.buckets['contract']
+        started = time.monotonic()
+        with self.cond:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+            self.max_depth = max(self.max_depth, len(self.waiting))
+            EXCHANGE_QUEUE_DEPTH.set(len(self.waiting))
+            self.cond.notify_all()
+            while True:
+                if self.waiting[0] != ticket:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic()
+                delay = max(self.spacing.wait_time(1, now), bucket.wait_time(weight, now))
+                if delay <= 0:
+                    break
+                # A more urgent arrival wakes this up and takes the head instead
+                self.wait_for_budget(delay)
+            heapq.heappop(self.waiting)
+            EXCHANGE_QUEUE_DEPTH.set(len(self.waiting))
+            # Like ccxt's throttle, a heavier call also pushes back the next one
+            self.spacing.take(weight)
+            bucket.take(weight)
+            self.cond.notify_all()
+
+            waited = time.monotonic() - started
+            stats = self.waits.setdefault(priority, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+        EXCHANGE_WAIT.observe(waited, priority=PRIORITY_NAMES.get(priority, str(priority)))
+        return waited
+
+    def wait_for_budget(self, delay):
+        """Waits up to delay seconds for budget to refill; called holding the lock."""
+        self.cond.wait(delay)
+
+    def coalesce(self, key, request):
+        """Runs request, or waits for the identical one already in flight and returns a copy of its result."""
+        with self.inflight_lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+        if not leader:
+            EXCHANGE_COALESCED.inc(endpoint=key[0])
+            with self.cond:
+                self.coalesced += 1
+            return copy.deepcopy(future.result())
+
+        try:
+            result = request()
+        except BaseException as e:
+            with self.inflight_lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.inflight_lock:
+            del self.inflight[key]
+        future.set_result(result)
+        return result
+
+    def summary(self, reset=True):
+        with self.cond:
+            parts = []
+            for priority, (count, total, longest) in sorted(self.waits.items()):
+                if count:
+                    name = PRIORITY_NAMES.get(priority, str(priority))
+                    parts.append(f"{name} {count} (wait avg {total / count:.2f}s, max {longest:.2f}s)")
+            line = (f"Requests: {', '.join(parts) or 'none'}; queue depth {len(self.waiting)} "
+                    f"(max {self.max_depth}), coalesced {self.coalesced}")
+        if reset:
+            self.reset_stats()
+        return line
+
+
+REST_CALL_PREFIXES = ('fetch', 'create', 'cancel', 'edit', 'load_markets', 'loadMarkets', 'private_')
+READ_CALL_PREFIXES = ('fetch', 'load_markets', 'loadMarkets')
+
+
+class RateLimitedExchange:
+    """Proxy that routes every REST call of a ccxt exchange through a shared RequestScheduler.
+
+    Calls queue at the priority set by request_priority(). Reads with the same
+    arguments as one already in flight share its response.
+    """
+
+    def __init__(self, exchange, scheduler):
+        self._exchange = exchange
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        attr = getattr(self._exchange, name)
+        if not callable(attr) or not name.startswith(REST_CALL_PREFIXES):
+            return attr
+
+        def call(*args, **kwargs):
+            def request():
+                self.scheduler.acquire(name, request_priority_var.get())
+                started = time.perf_counter()
+                try:
+                    return attr(*args, **kwargs)
+                except Exception as e:
+                    EXCHANGE_ERRORS.inc(endpoint=name, code=error_code(e))
+                    raise
+                finally:
+                    EXCHANGE_LATENCY.observe(time.perf_counter() - started, endpoint=name)
+            if name.startswith(READ_CALL_PREFIXES):
+                return self.scheduler.coalesce((name, repr(args), repr(sorted(kwargs.items()))), request)
+            return request()
+        return call
+
+
+def create_exchange(mock_options=None, credentials=None):
+    """Live phemex client, or a MockPhemex when EXCHANGE=mock or mock_options are given.
+
+    credentials ({'apiKey': ..., 'secret': ...}) default to API_KEY/SECRET.
+    Every client gets its own request scheduler, so its own rate budget.
+    """
+    if EXCHANGE == 'mock' or mock_options is not None:
+        from mock_exchange import MockPhemex
+        exchange = MockPhemex(**(mock_options or {'n_positions': MOCK_POSITIONS, 'latency': MOCK_LATENCY}))
+    else:
+        # ccxt's own throttle is not thread-safe, so the shared limiter replaces it
+        exchange = ccxt.phemex({
+            **(credentials if credentials is not None else {'apiKey': api_key, 'secret': secret}),
+            'enableRateLimit': False,
+        })
+    return RateLimitedExchange(exchange, RequestScheduler(1000 / exchange.rateLimit, costs=endpoint_costs(exchange)))
 
 def cancel_thread_func(exchange, pos, symbol, order_type):
     try:
         cancel_orphan_orders(exchange, pos, symbol, order_type)
     except Exception as e:
-        print(f"Error in cancel_orphan_orders for {symbol}: {e}")
-        traceback.print_exc()
+        logger.exception(f"Error in cancel_orphan_orders for {symbol}: {e}")
 
 def monitor_thread_func(exchange, symbol, pos):
     try:
         monitor_position_and_reenter(exchange, symbol, pos)
     except Exception as e:
-        print(f"Error in monitor_position_and_reenter for {symbol}: {e}")
-        traceback.print_exc()
+        logger.exception(f"Error in monitor_position_and_reenter for {symbol}: {e}")
+
+class BalanceCache:
+    """Free USDT swap balance, refreshed on a TTL or when an account event invalidates it.
+
+    Re-entries reserve their margin locally, so concurrent orders within one
+    tick can't overspend a balance that was fetched once.
+    """
+
+    def __init__(self, exchange, ttl=BALANCE_TTL):
+        self.exchange = exchange
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.balance = 0.0
+        self.fetched_at = None
+
+    def refresh_if_stale(self):
+        # Called with the lock held, so only one thread fetches
+        if self.fetched_at is not None and time.monotonic() - self.fetched_at < self.ttl:
+            CACHE_REQUESTS.inc(cache='balance', result='hit')
+            return
+        CACHE_REQUESTS.inc(cache='balance', result='miss')
+        balance_info = self.exchange.fetch_balance({'type': 'swap'})
+        self.balance = float(balance_info.get('USDT', {}).get('free') or 0)
+        self.fetched_at = time.monotonic()
+
+    def free(self):
+        with self.lock:
+            self.refresh_if_stale()
+            return self.balance
+
+    def try_reserve(self, amount):
+        with self.lock:
+            self.refresh_if_stale()
+            if self.balance < amount:
+                return False
+            self.balance -= amount
+            return True
+
+    def release(self, amount):
+        with self.lock:
+            self.balance += amount
+
+    def update(self, free):
+        with self.lock:
+            self.balance = float(free)
+            self.fetched_at = time.monotonic()
+
+    def invalidate(self):
+        with self.lock:
+            self.fetched_at = None
+
+
+def build_symbol_info(market):
+    price_precision_val = market['precision']['price']
+    amount_precision_val = market['precision']['amount']
+    return {
+        'price_sig_digits': count_sig_digits(price_precision_val),
+        'amount_sig_digits': count_sig_digits(amount_precision_val),
+        'tick_size': price_precision_val,
+        'contract_size': market.get('contractSize') or 1,
+    }
+
+
+# What ccxt's set_markets() fills in; sharing these shares one copy of the markets
+MARKET_ATTRIBUTES = ('markets', 'markets_by_id', 'symbols', 'ids', 'currencies', 'currencies_by_id', 'codes')
+
+
+def share_markets(source, target):
+    """Points target's market tables at source's, so several clients hold one copy."""
+    source = getattr(source, '_exchange', source)
+    target = getattr(target, '_exchange', target)
+    for name in MARKET_ATTRIBUTES:
+        if hasattr(source, name):
+            setattr(target, name, getattr(source, name))
+
+
+class MarketCache:
+    """USDT swap markets plus a per-symbol precision table, refreshed in the background.
+
+    The raw markets are snapshotted to disk so a restart can hand them straight
+    to ccxt instead of downloading them again.
+    """
+
+    def __init__(self, exchange, ttl=MARKET_CACHE_TTL, snapshot_file=MARKET_CACHE_FILE):
+        self.exchange = exchange
+        self.ttl = ttl
+        self.snapshot_file = snapshot_file
+        self.lock = threading.Lock()
+        self.symbols = []
+        self.table = {}
+        self.loaded_at = 0
+        self.stop_event = threading.Event()
+        # Other clients (one per account) that share these markets instead of loading their own
+        self.followers = []
+
+    def start(self):
+        if not self.load_snapshot():
+            self.refresh()
+        threading.Thread(target=self.refresh_loop, name="market-cache", daemon=True).start()
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_file, "r") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.exchange.set_markets(snapshot['markets'], snapshot.get('currencies'))
+        self.build(snapshot['markets'], snapshot['saved_at'])
+        logger.info(f"📦 Loaded {len(self.symbols)} markets from {self.snapshot_file}")
+        return True
+
+    def save_snapshot(self):
+        snapshot = {
+            'saved_at': self.loaded_at,
+            'markets': self.exchange.markets,
+            'currencies': self.exchange.currencies,
+        }
+        tmp_path = f"{self.snapshot_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.snapshot_file)
+
+    def follow(self, client):
+        self.followers.append(client)
+        share_markets(self.exchange, client)
+
+    def refresh(self):
+        markets = self.exchange.load_markets(reload=True)
+        self.build(markets, time.time())
+        for client in self.followers:
+            share_markets(self.exchange, client)
+        try:
+            self.save_snapshot()
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ Could not save market snapshot: {e}")
+
+    def build(self, markets, loaded_at):
+        symbols = [symbol for symbol in markets if ":USDT" in symbol]
+        table = {symbol: build_symbol_info(markets[symbol]) for symbol in symbols}
+        with self.lock:
+            self.symbols = symbols
+            self.table = table
+            self.loaded_at = loaded_at
+
+    def refresh_loop(self):
+        # A stale snapshot gets refreshed right away, without blocking startup
+        while not self.stop_event.wait(max(0, self.loaded_at + self.ttl - time.time())):
+            try:
+                self.refresh()
+                logger.info(f"🔄 Refreshed {len(self.symbols)} markets")
+            except Exception as e:
+                logger.warning(f"⚠️ Market refresh failed: {e}")
+                self.stop_event.wait(60)
+
+    def symbol_info(self, symbol):
+        info = self.table.get(symbol)
+        CACHE_REQUESTS.inc(cache='symbol_info', result='hit' if info is not None else 'miss')
+        if info is None:
+            # Listed after the last refresh
+            info = build_symbol_info(self.exchange.markets[symbol])
+            with self.lock:
+                self.table[symbol] = info
+        return info
+
+
+def run_positions(exchange, positions, open_orders=None, reentry=True):
+    """Risk pass over every position at once, then exchange calls only where an action is due.
+
+    Each symbol's actions run in order on the position pool, so a pass takes
+    about as long as the slowest symbol. Where the exchange takes bulk
+    creates, re-entries go out together once the stop work is done. Returns
+    the symbols that failed.
+    """
+    if reentry and open_orders is None:
+        open_orders = OpenOrdersSnapshot.fetch(exchange, [pos.symbol for pos in positions])
+    with tick_stats.stage('risk_pass'):
+        position_modes.learn(positions)
+        frame = build_position_frame(positions, open_orders)
+        actions = plan_actions(frame, 0.10, 0.10, reentry=reentry)
+        if open_orders is not None:
+            # Without its open orders a symbol may already have its re-entry resting
+            actions = [a for a in actions if a['action'] != 'reenter' or open_orders.has_symbol(a['symbol'])]
+    bulk = exchange.has.get('createOrders')
+    reentries = [action for action in actions if action['action'] == 'reenter'] if bulk else []
+    by_symbol = {}
+    for action in actions:
+        if not (bulk and action['action'] == 'reenter'):
+            by_symbol.setdefault(action['symbol'], []).append(action)
+    # Symbols with stop work go to the pool first; the scheduler orders their calls too
+    queued = sorted(by_symbol.values(), key=lambda symbol_actions: all(a['action'] == 'reenter' for a in symbol_actions))
+    results = pool_map(lambda symbol_actions: execute_actions(exchange, symbol_actions), queued)
+    failed = [symbol for symbol_failed in results for symbol in symbol_failed]
+    if reentries:
+        with tick_stats.stage('reentry'), request_priority(PRIORITY_REENTRY):
+            failed += place_reentries(exchange, reentries)
+    POSITIONS_PROCESSED.inc(len(positions))
+    logger.info(f"📊 Risk pass: {len(positions)} positions, {len(actions)} actions on {len({a['symbol'] for a in actions})} symbols",
+                extra={'positions': len(positions), 'actions': len(actions)})
+    return failed
+
+
+position_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="position")
+
+
+def pool_map(fn, items):
+    """position_pool.map, with each call run in a copy of the caller's context (request priority, account)."""
+    jobs = [(contextvars.copy_context(), item) for item in items]
+    return position_pool.map(lambda job: job[0].run(fn, job[1]), jobs)
+
+class TickStats:
+    """Wall time of each stage of the current tick.
+
+    Stages timed from pool workers (trailing, reentry) add up across threads,
+    so they show total worker time rather than elapsed time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            TICK_STAGE.observe(elapsed, stage=name)
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def summary(self):
+        with self.lock:
+            return ", ".join(f"{name} {elapsed:.2f}s" for name, elapsed in self.stages.items())
+
+
+tick_stats = TickStats()
+
+
+class TickScheduler:
+    """Runs a job at a fixed rate without drift, never two ticks at once.
+
+    Ticks are aligned to a fixed grid of start times. A tick that runs past its
+    slot counts as an overrun, and the slots it covered are skipped rather than
+    queued up.
+    """
+
+    def __init__(self, job, interval=TICK_INTERVAL, idle=None):
+        self.job = job
+        self.interval = interval
+        # Called with the next tick's start time instead of sleeping until it
+        self.idle = idle
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+
+    def run_forever(self):
+        next_run = time.monotonic()
+        while True:
+            if self.idle is not None and next_run > time.monotonic():
+                try:
+                    self.idle(next_run)
+                except Exception:
+                    logger.exception("Idle work between ticks crashed")
+            delay = next_run - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            tick_stats.reset()
+            started = time.monotonic()
+            try:
+                self.job()
+            except Exception:
+                logger.exception("Tick crashed")
+            duration = time.monotonic() - started
+            self.ticks += 1
+
+            next_run += self.interval
+            behind = time.monotonic() - next_run
+            if behind > 0:
+                missed = int(behind // self.interval) + 1
+                self.overruns += 1
+                self.skipped += missed
+                next_run += missed * self.interval
+                TICK_OVERRUNS.inc()
+                logger.warning(f"🐢 Tick {self.ticks} overran the {self.interval:g}s interval, skipping {missed} tick(s)")
+            TICK_DURATION.observe(duration)
+            logger.info(f"⏱️ Tick {self.ticks} took {duration:.2f}s ({tick_stats.summary()}) "
+                        f"— overruns {self.overruns}/{self.ticks}, skipped {self.skipped}",
+                        extra={'tick': self.ticks, 'duration': round(duration, 3)})
+
+
+class CadencePlanner:
+    """Per-position check cadence, driven by how close each position is to acting.
+
+    A position's urgency is the larger of its closeness to liquidation and its
+    profit distance as a share of the next trailing threshold, both in 0..1.
+    Between ticks, positions at or above stable_below are re-read every
+    tick_interval * (1 - urgency) ** 2 seconds and get a trailing pass on the
+    fresh mark price. One poll round is a single fetch_positions call (weight
+    1) for every symbol due, at most poll_rate rounds a second; tickers would
+    cost 5 each from the much smaller public budget. Positions below
+    stable_below only get the per-symbol open-orders fetch and re-entry check
+    every stable_interval seconds, which frees the contract budget the polls
+    spend.
+    """
+
+    def __init__(self, exchange, tick_interval=TICK_INTERVAL, min_interval=ADAPTIVE_MIN_INTERVAL,
+                 poll_rate=ADAPTIVE_POLL_RATE, stable_interval=ADAPTIVE_STABLE_INTERVAL,
+                 stable_below=ADAPTIVE_STABLE_BELOW, enabled=ADAPTIVE_POLLING):
+        self.exchange = exchange
+        self.tick_interval = tick_interval
+        self.min_interval = min_interval
+        self.poll_rate = poll_rate
+        self.stable_interval = stable_interval
+        self.stable_below = stable_below
+        self.enabled = enabled
+        self.urgency = {}
+        # (symbol, side) -> Position from the last tick, marks updated by polls
+        self.positions = {}
+        # symbol -> monotonic time of the next poll / full check
+        self.next_poll = {}
+        self.next_full_check = {}
+
+    def interval(self, urgency):
+        return min(self.tick_interval, max(self.min_interval, self.tick_interval * (1 - urgency) ** 2))
+
+    def full_check_symbols(self, positions):
+        """Symbols whose open orders and re-entry are checked this tick."""
+        symbols = {pos.symbol for pos in positions if pos.contracts > 0}
+        if not self.enabled:
+            return symbols
+        now = time.monotonic()
+        return {symbol for symbol in symbols if self.next_full_check.get(symbol, 0) <= now}
+
+    def checked(self, symbols):
+        now = time.monotonic()
+        for symbol in symbols:
+            stable = self.urgency.get(symbol, 1.0) < self.stable_below
+            self.next_full_check[symbol] = now + (self.stable_interval if stable else 0)
+
+    def update(self, positions):
+        """Recomputes every position's urgency from the tick's Positions."""
+        positions = [pos for pos in positions if pos.is_open and pos.entry_price > 0]
+        self.positions = {(pos.symbol, pos.side): pos for pos in positions}
+        self.urgency = {}
+        if not positions:
+            self.next_poll = {}
+            return
+        entry = np.array([pos.entry_price for pos in positions])
+        mark = np.array([pos.mark_price for pos in positions])
+        liq = np.array([pos.liquidation_price for pos in positions])
+        leverage = np.array([pos.leverage for pos in positions])
+        threshold = np.array([
+            (load_trailing_data(pos.symbol, pos.side) or DEFAULT_TRAILING_DATA)['threshold'] for pos in positions
+        ])
+        zeros = np.zeros(len(positions))
+        profit_distance = trailing_signals(
+            np.array([pos.side == 'long' for pos in positions]), entry, mark, zeros, leverage, zeros, threshold, threshold,
+        )[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            trailing = np.clip(np.nan_to_num(profit_distance / threshold), 0, 1)
+        closeness = np.clip(np.nan_to_num(liquidation_closeness(entry, mark, liq)), 0, 1)
+        for pos, urgency in zip(positions, np.maximum(trailing, closeness)):
+            self.urgency[pos.symbol] = max(self.urgency.get(pos.symbol, 0.0), float(urgency))
+
+        now = time.monotonic()
+        self.next_poll = {
+            symbol: now + self.interval(urgency)
+            for symbol, urgency in self.urgency.items()
+            if urgency >= self.stable_below and self.interval(urgency) < self.tick_interval
+        }
+
+    def poll_until(self, deadline):
+        """Runs poll rounds for the urgent positions until deadline; sleeps when none is due."""
+        spacing = 1 / self.poll_rate
+        while True:
+            now = time.monotonic()
+            next_due = min(self.next_poll.values(), default=deadline) if self.enabled else deadline
+            wake = min(next_due, deadline)
+            if wake > now:
+                time.sleep(wake - now)
+            if wake >= deadline:
+                return
+            round_started = time.monotonic()
+            self.poll(sorted(symbol for symbol, due in self.next_poll.items() if due <= round_started))
+            # Keep poll rounds within the ticker budget
+            time.sleep(max(0, min(deadline, round_started + spacing) - time.monotonic()))
+
+    def poll(self, symbols):
+        """Re-reads the positions of symbols in one call and re-runs the trailing stops whose mark moved."""
+        try:
+            fresh = {(pos.symbol, pos.side): pos for pos in parse_positions(self.exchange.fetch_positions(symbols=symbols))}
+        except Exception as e:
+            logger.warning(f"⚠️ Position poll for {len(symbols)} symbols failed: {e}")
+            fresh = {}
+        moved = []
+        for symbol in symbols:
+            for side in ['long', 'short']:
+                pos, new = self.positions.get((symbol, side)), fresh.get((symbol, side))
+                if pos is None or new is None or not new.is_open:
+                    # Closed positions are cleaned up by the next tick
+                    continue
+                self.positions[(symbol, side)] = new
+                if new.mark_price != pos.mark_price:
+                    moved.append(new)
+            self.next_poll[symbol] = time.monotonic() + self.interval(self.urgency[symbol])
+        POLLED_SYMBOLS.inc(len(symbols))
+        if moved:
+            try:
+                run_positions(self.exchange, moved, reentry=False)
+            finally:
+                flush_trailing_data()
+
+
+cadence = None
+
 
 def main_job():
     try:
-        # Use the global exchange instance
-        global exchange
-
-        markets = exchange.load_markets()
-        all_symbols = [symbol for symbol in markets if ":USDT" in symbol]
-        positionst = exchange.fetch_positions(symbols=all_symbols)
-        usdt_balance = exchange.fetch_balance({'type': 'swap'})['USDT']['free']
-        print("USDT Balance: ", usdt_balance)
-
-        for pos in positionst:
-            symbol = pos['symbol']
-            trailing_stop_logic(exchange, pos, 0.10, 0.10)
-
-            if pos.get('contracts', 0) > 0:
-                monitor_position_and_reenter(exchange, symbol, pos)         
-                
+        # Use the global exchange and market cache instances
+        global exchange, market_cache
+
+        all_symbols = market_cache.symbols
+        with tick_stats.stage('fetch_positions'):
+            positionst = active_universe.fetch_positions(exchange, all_symbols)
+        OPEN_POSITIONS.set(sum(1 for pos in positionst if pos.is_open))
+        logger.info(f"USDT Balance: {balance_cache.free()}")
+
+        # One open-orders snapshot per tick, shared by every position; it also
+        # covers symbols without a position last seen with working orders, to
+        # notice when they go
+        with tick_stats.stage('open_orders'):
+            open_symbols = cadence.full_check_symbols(positionst)
+            orders_only = active_universe.order_symbols() - {pos.symbol for pos in positionst if pos.contracts > 0}
+            open_orders = OpenOrdersSnapshot.fetch(exchange, sorted(open_symbols | orders_only))
+            active_universe.update_orders(open_orders)
+
+        failed = run_positions(exchange, positionst, open_orders)
+        if failed:
+            logger.warning(f"⚠️ Actions failed this tick for: {', '.join(sorted(set(failed)))}")
+        cadence.update(positionst)
+        cadence.checked(open_orders.symbols & open_symbols)
+
         # # Run cancel_orphan_orders in its own thread immediately
         # cancel_orphan_orders(exchange, all_symbols, 'limit')
 
-        cleanup_closed_trailing_files(exchange, all_symbols)
+        with tick_stats.stage('cleanup'):
+            cleanup_closed_trailing_files(exchange, all_symbols, positionst)
+        logger.info(f"🚦 {exchange.scheduler.summary()}")
+        return positionst
 
     except Exception as e:
-        print("Error inside main_job:")
-        traceback.print_exc()
+        logger.exception("Error inside main_job")
+        return None
+    finally:
+        flush_trailing_data()
 
-if __name__ == "__main__":
-    exchange = create_exchange()
 
-    # Schedule main_job every 10 seconds
-    schedule.every(10).seconds.do(main_job)
+class PositionStream(abc.ABC):
+    """Pluggable source of position, mark-price and order events.
+
+    Implementations push (kind, symbol, payload) tuples onto self.events from
+    any thread, where kind is 'position', 'mark', 'order' or 'balance'.
+    """
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.symbols = set()
+
+    @abc.abstractmethod
+    def start(self):
+        """Starts delivering events, without blocking the caller."""
 
-    print("Starting scheduler...")
+    def set_symbols(self, symbols):
+        self.symbols = set(symbols)
+
+    def emit(self, kind, symbol, payload):
+        self.events.put((kind, symbol, payload))
+
+
+class CcxtProStream(PositionStream):
+    """Phemex websocket streams through ccxt.pro, run on their own event loop thread.
+
+    credentials ({'apiKey': ..., 'secret': ...}) default to API_KEY/SECRET.
+    """
+
+    def __init__(self, markets=None, currencies=None, credentials=None):
+        super().__init__()
+        if ccxtpro is None:
+            raise RuntimeError("ccxt.pro is not available in this ccxt install")
+        self.markets = markets
+        self.currencies = currencies
+        self.credentials = credentials if credentials is not None else {'apiKey': api_key, 'secret': secret}
+
+    def start(self):
+        # The stream thread logs and counts under the account that started it
+        context = contextvars.copy_context()
+        threading.Thread(
+            target=lambda: context.run(asyncio.run, self.run()), name="stream", daemon=True,
+        ).start()
+
+    async def run(self):
+        client = ccxtpro.phemex(dict(self.credentials))
+        if self.markets:
+            client.set_markets(self.markets, self.currencies)
+        watchers = [self.watch_orders(client), self.watch_marks(client), self.watch_balance(client)]
+        if client.has.get('watchPositions'):
+            watchers.append(self.watch_positions(client))
+        try:
+            await asyncio.gather(*watchers)
+        finally:
+            await client.close()
+
+    async def watch_forever(self, name, watch_once):
+        while True:
+            try:
+                await watch_once()
+            except Exception as e:
+                logger.warning(f"⚠️ {name} stream error: {e} — reconnecting")
+                await asyncio.sleep(5)
+
+    async def watch_orders(self, client):
+        async def once():
+            for order in await client.watch_orders(params={'type': 'swap', 'settle': 'USDT'}):
+                self.emit('order', order['symbol'], order)
+        await self.watch_forever("orders", once)
+
+    async def watch_marks(self, client):
+        async def once():
+            if not self.symbols:
+                await asyncio.sleep(1)
+                return
+            tickers = await client.watch_tickers(list(self.symbols))
+            for symbol, ticker in tickers.items():
+                mark_price = ticker.get('markPrice') or ticker.get('last')
+                if mark_price:
+                    self.emit('mark', symbol, mark_price)
+        await self.watch_forever("mark price", once)
+
+    async def watch_balance(self, client):
+        async def once():
+            balance = await client.watch_balance(params={'type': 'swap', 'settle': 'USDT'})
+            free = balance.get('USDT', {}).get('free')
+            if free is not None:
+                self.emit('balance', None, free)
+        await self.watch_forever("balance", once)
+
+    async def watch_positions(self, client):
+        async def once():
+            for position in await client.watch_positions():
+                self.emit('position', position['symbol'], position)
+        await self.watch_forever("positions", once)
+
+
+def process_stream_events(exchange, stream, positions, wait=1.0):
+    """Drain pending stream events and run the strategy only on symbols that changed.
+
+    positions maps (symbol, side) to Position, so both sides of a hedge-mode
+    symbol are tracked. Mark-price moves only re-run the trailing stop. Order
+    and position events also refresh the position over REST and re-run the
+    re-entry check.
+    """
+    mark_changed, state_changed = set(), set()
+    try:
+        events = [stream.events.get(timeout=wait)]
+    except queue.Empty:
+        return
     while True:
         try:
-            schedule.run_pending()
-            time.sleep(1)
+            events.append(stream.events.get_nowait())
+        except queue.Empty:
+            break
+
+    for kind, symbol, payload in events:
+        if kind == 'mark':
+            for side in ['long', 'short']:
+                pos = positions.get((symbol, side))
+                if pos is not None and pos.mark_price != float(payload):
+                    pos.mark_price = float(payload)
+                    mark_changed.add((symbol, side))
+        elif kind == 'position':
+            pos = Position.parse(payload)
+            if pos.is_open:
+                positions[(symbol, pos.side)] = pos
+            state_changed.add(symbol)
+        elif kind == 'order':
+            state_changed.add(symbol)
+            # Fills and cancels move margin around
+            balance_cache.invalidate()
+        elif kind == 'balance':
+            balance_cache.update(payload)
+
+    if state_changed:
+        try:
+            refreshed = parse_positions(exchange.fetch_positions(symbols=list(state_changed)))
+            returned = {pos.symbol for pos in refreshed}
+            open_now = {(pos.symbol, pos.side): pos for pos in refreshed if pos.is_open}
+            # Only the sides that came back flat are dropped; hedge mode lists both
+            for key in [key for key in positions if key[0] in returned and key not in open_now]:
+                del positions[key]
+            positions.update(open_now)
         except Exception as e:
-            print("Scheduler crashed:")
-            traceback.print_exc()
-            print("Retrying in 10 seconds...")
-            time.sleep(10)
+            logger.warning(f"⚠️ Failed to refresh positions {sorted(state_changed)}: {e}")
+        stream.set_symbols({symbol for symbol, _ in positions})
+
+    changed = [pos for (symbol, _), pos in positions.items() if symbol in state_changed]
+    if changed:
+        run_positions(exchange, changed)
+    moved = [positions[key] for key in mark_changed if key[0] not in state_changed and key in positions]
+    if moved:
+        run_positions(exchange, moved, reentry=False)
+    flush_trailing_data()
+
+
+def run_stream_mode(stream):
+    positions = {}
+    last_reconcile = 0
+    logger.info("Starting stream mode...")
+    stream.start()
+    while True:
+        try:
+            # REST polling stays on as a periodic reconciliation of the streamed state
+            if time.monotonic() - last_reconcile >= RECONCILE_INTERVAL:
+                last_reconcile = time.monotonic()
+                positionst = main_job()
+                if positionst is not None:
+                    positions = {(pos.symbol, pos.side): pos for pos in positionst if pos.is_open}
+                    stream.set_symbols({symbol for symbol, _ in positions})
+            process_stream_events(exchange, stream, positions)
+        except Exception:
+            logger.exception("Stream loop crashed")
+            time.sleep(5)
+
+if __name__ == "__main__":
+    setup_logging()
+    start_metrics_server()
+    exchange = create_exchange()
+    trailing_store = create_trailing_store()
+    # Persist and fsync trailing state on exit, including Railway's SIGTERM
+    atexit.register(trailing_store.close)
+    order_journal = OrderJournal()
+    atexit.register(order_journal.close)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    balance_cache = BalanceCache(exchange)
+    position_modes = PositionModeCache()
+    market_cache = MarketCache(exchange)
+    market_cache.start()
+    cadence = CadencePlanner(exchange)
+    recover_from_journal(exchange, order_journal)
+
+    if STREAM_MODE:
+        run_stream_mode(CcxtProStream(exchange.markets, exchange.currencies))
+
+    logger.info("Starting scheduler...")
+    TickScheduler(main_job, TICK_INTERVAL, idle=cadence.poll_until).run_forever()
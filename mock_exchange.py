@@ -0,0 +1,397 @@
+"""A local, deterministic stand-in for the ccxt phemex client.
+
+Serves the part of the ccxt API the bot uses from an in-memory book, so the
+tick loop can be run and benchmarked without API keys or network. Latency,
+the exchange-side rate limit and error injection (including phemex's
+TE_ERR_INCONSISTENT_POS_MODE for a posSide that does not match the symbol's
+position mode) are all configurable. main.create_exchange() returns one when
+EXCHANGE=mock.
+"""
+import itertools
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+import ccxt
+
+MAINTENANCE_MARGIN_RATE = 0.005
+
+POS_MODE_ERROR = 'phemex {"code":20004,"msg":"TE_ERR_INCONSISTENT_POS_MODE","data":null}'
+RATE_LIMIT_ERROR = 'phemex {"code":429,"msg":"Too many requests"}'
+
+
+class MockPhemex:
+    """In-memory phemex: markets, positions, open orders and a USDT balance.
+
+    Every REST method is counted in self.calls. Mark prices take one seeded
+    random-walk step per fetch_positions call; stops and re-entry limits fill
+    when the mark crosses them, and a closed position is reopened on a free
+    symbol so the number of positions stays steady.
+    """
+
+    id = 'phemex'
+
+    def __init__(self, n_symbols=600, n_positions=10, seed=0, latency=0.0, jitter=0.0,
+                 rate_limit=120.5, burst=None, hedge_ratio=0.5, report_pos_mode=True,
+                 error_rates=None, volatility=0.004, leverage=10, balance=1_000_000.0,
+                 step_on_fetch=True, bulk_orders=False):
+        self.rng = random.Random(seed)
+        self.lock = threading.RLock()
+        self.latency = latency
+        self.jitter = jitter
+        # Same meaning as ccxt's rateLimit: milliseconds between requests
+        self.rateLimit = rate_limit
+        self.refill_per_sec = 1000 / rate_limit
+        self.burst = burst or max(1.0, self.refill_per_sec)
+        self.tokens = self.burst
+        self.refilled_at = time.monotonic()
+        self.report_pos_mode = report_pos_mode
+        self.error_rates = error_rates or {}
+        self.volatility = volatility
+        self.leverage = leverage
+        self.step_on_fetch = step_on_fetch
+        self.calls = Counter()
+        self.rejected = Counter()
+        self.order_ids = itertools.count(1)
+        self.has = {
+            'fetchPositions': True,
+            'fetchOpenOrders': True,
+            'fetchBalance': True,
+            'fetchTicker': True,
+            'fetchTickers': True,
+            'createOrder': True,
+            # phemex has neither; bulk_orders turns them on to exercise batch code paths
+            'createOrders': bulk_orders,
+            'editOrder': True,
+            'cancelOrder': True,
+            'cancelOrders': bulk_orders,
+            'cancelAllOrders': True,
+        }
+
+        self.listed = self.build_markets(n_symbols)
+        self.listed_by_id = {market['id']: symbol for symbol, market in self.listed.items()}
+        self.markets = {}
+        self.currencies = {}
+        self.marks = {symbol: market['info']['price'] for symbol, market in self.listed.items()}
+        self.modes = {
+            symbol: 'hedge' if self.rng.random() < hedge_ratio else 'oneway' for symbol in self.listed
+        }
+        self.positions = {}
+        self.orders = {}
+        self.balance = balance
+        self.target_positions = min(n_positions, n_symbols)
+        for symbol in self.rng.sample(list(self.listed), self.target_positions):
+            self.open_position(symbol)
+
+    def build_markets(self, n_symbols):
+        markets = {}
+        for i in range(n_symbols):
+            base = f"M{i:03d}"
+            symbol = f"{base}/USDT:USDT"
+            price = 10 ** self.rng.uniform(-2, 4)
+            tick = 10 ** (math.floor(math.log10(price)) - 4)
+            markets[symbol] = {
+                'id': f"{base}USDT",
+                'symbol': symbol,
+                'base': base,
+                'quote': 'USDT',
+                'settle': 'USDT',
+                'type': 'swap',
+                'spot': False,
+                'swap': True,
+                'linear': True,
+                'contract': True,
+                'active': True,
+                'contractSize': 1.0,
+                'precision': {'price': tick, 'amount': 0.001},
+                'limits': {'amount': {'min': 0.001}, 'leverage': {'max': 100}},
+                'info': {'price': price},
+            }
+        return markets
+
+    def request(self, method):
+        """Bookkeeping shared by every REST call: count, latency, rate limit, injected errors."""
+        with self.lock:
+            self.calls[method] += 1
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.refill_per_sec)
+            self.refilled_at = now
+            if self.tokens < 1:
+                self.rejected[method] += 1
+                raise ccxt.RateLimitExceeded(RATE_LIMIT_ERROR)
+            self.tokens -= 1
+            failing = self.rng.random() < self.error_rates.get(method, 0)
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if failing:
+            raise ccxt.NetworkError(f"phemex injected failure in {method}")
+
+    def check_pos_mode(self, symbol, params):
+        pos_side = (params or {}).get('posSide')
+        hedge = self.modes[symbol] == 'hedge'
+        if hedge != (pos_side in ('Long', 'Short')):
+            raise ccxt.ExchangeError(POS_MODE_ERROR)
+
+    def market(self, symbol):
+        if symbol not in self.listed:
+            raise ccxt.BadSymbol(f"phemex does not have market symbol {symbol}")
+        return self.listed[symbol]
+
+    # Market metadata
+
+    def load_markets(self, reload=False, params={}):
+        if reload or not self.markets:
+            self.request('load_markets')
+            self.set_markets(self.listed)
+        return self.markets
+
+    def set_markets(self, markets, currencies=None):
+        self.markets = dict(markets)
+        self.currencies = currencies or {'USDT': {'id': 'USDT', 'code': 'USDT', 'precision': 0.0001}}
+        return self.markets
+
+    # Simulated market
+
+    def open_position(self, symbol):
+        self.positions[symbol] = {
+            'side': 'long' if self.rng.random() < 0.5 else 'short',
+            'contracts': round(100 / self.marks[symbol], 3) or 0.001,
+            'entry': self.marks[symbol],
+            'leverage': self.leverage,
+            'realised': 0.0,
+        }
+
+    def advance(self):
+        """Moves every mark one step and fills whatever orders it crossed."""
+        with self.lock:
+            for symbol in self.marks:
+                self.marks[symbol] *= math.exp(self.rng.gauss(0, self.volatility))
+            for order in list(self.orders.values()):
+                self.try_fill(order)
+            free = [symbol for symbol in self.listed if symbol not in self.positions]
+            while len(self.positions) < self.target_positions and free:
+                self.open_position(free.pop(self.rng.randrange(len(free))))
+
+    def try_fill(self, order):
+        symbol = order['symbol']
+        mark = self.marks[symbol]
+        position = self.positions.get(symbol)
+        if order['type'] == 'stop':
+            stop = order['stopPrice']
+            if not (mark <= stop if order['side'] == 'sell' else mark >= stop):
+                return
+            del self.orders[order['id']]
+            if position is not None:
+                direction = 1 if position['side'] == 'long' else -1
+                self.balance += direction * (stop - position['entry']) * position['contracts']
+                del self.positions[symbol]
+        else:
+            if not (mark <= order['price'] if order['side'] == 'buy' else mark >= order['price']):
+                return
+            del self.orders[order['id']]
+            if position is None:
+                return
+            total = position['contracts'] + order['amount']
+            position['entry'] = (position['entry'] * position['contracts'] + order['price'] * order['amount']) / total
+            position['contracts'] = total
+
+    def position_payload(self, symbol, position):
+        mark = self.marks[symbol]
+        direction = 1 if position['side'] == 'long' else -1
+        leverage = position['leverage']
+        liquidation = position['entry'] * (1 - direction * (1 / leverage - MAINTENANCE_MARGIN_RATE))
+        info = {
+            'symbol': self.listed[symbol]['id'],
+            'curTermRealisedPnlRv': str(position['realised']),
+        }
+        if self.report_pos_mode:
+            hedge = self.modes[symbol] == 'hedge'
+            info['posMode'] = 'Hedged' if hedge else 'OneWay'
+            info['posSide'] = position['side'].capitalize() if hedge else 'Merged'
+        return {
+            'info': info,
+            'symbol': symbol,
+            'side': position['side'],
+            'contracts': position['contracts'],
+            'contractSize': 1.0,
+            'entryPrice': position['entry'],
+            'markPrice': mark,
+            'notional': position['contracts'] * mark,
+            'leverage': leverage,
+            'liquidationPrice': liquidation,
+            'unrealizedPnl': direction * (mark - position['entry']) * position['contracts'],
+            'marginMode': 'cross',
+            'timestamp': int(time.time() * 1000),
+        }
+
+    def order_payload(self, order):
+        return {
+            **order,
+            'info': {'posSide': order['posSide']},
+            'status': 'open',
+            'triggerPrice': order['stopPrice'],
+        }
+
+    # REST API
+
+    def fetch_positions(self, symbols=None, params={}):
+        self.request('fetch_positions')
+        if self.step_on_fetch:
+            self.advance()
+        with self.lock:
+            wanted = set(symbols) if symbols else None
+            return [
+                self.position_payload(symbol, position)
+                for symbol, position in self.positions.items()
+                if wanted is None or symbol in wanted
+            ]
+
+    def fetch_balance(self, params={}):
+        self.request('fetch_balance')
+        with self.lock:
+            used = sum(
+                position['contracts'] * position['entry'] / position['leverage']
+                for position in self.positions.values()
+            )
+            free = max(0.0, self.balance - used)
+            return {
+                'USDT': {'free': free, 'used': used, 'total': free + used},
+                'free': {'USDT': free},
+                'used': {'USDT': used},
+                'total': {'USDT': free + used},
+            }
+
+    def fetch_ticker(self, symbol, params={}):
+        self.request('fetch_ticker')
+        self.market(symbol)
+        with self.lock:
+            mark = self.marks[symbol]
+        return {'symbol': symbol, 'last': mark, 'markPrice': mark, 'timestamp': int(time.time() * 1000)}
+
+    def fetch_tickers(self, symbols=None, params={}):
+        self.request('fetch_tickers')
+        with self.lock:
+            return {
+                symbol: {'symbol': symbol, 'last': mark, 'markPrice': mark}
+                for symbol, mark in self.marks.items()
+                if not symbols or symbol in symbols
+            }
+
+    def fetch_open_orders(self, symbol=None, since=None, limit=None, params={}):
+        if symbol is None:
+            # Same as the real client: phemex has no account-wide open-orders endpoint
+            raise ccxt.ArgumentsRequired('phemex fetchOpenOrders() requires a symbol argument')
+        self.request('fetch_open_orders')
+        self.market(symbol)
+        with self.lock:
+            return [self.order_payload(order) for order in self.orders.values() if order['symbol'] == symbol]
+
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        self.request('create_order')
+        return self.place_order(symbol, type, side, amount, price, params)
+
+    def create_orders(self, orders, params={}):
+        if not self.has['createOrders']:
+            raise ccxt.NotSupported('phemex createOrders() is not supported yet')
+        self.request('create_orders')
+        placed = []
+        for order in orders:
+            try:
+                placed.append(self.place_order(**order))
+            except ccxt.BaseError as e:
+                # Like ccxt, a rejected order comes back as a structure without an id
+                placed.append({'id': None, 'symbol': order['symbol'], 'status': 'rejected', 'info': str(e)})
+        return placed
+
+    def place_order(self, symbol, type, side, amount, price=None, params={}):
+        self.market(symbol)
+        params = params or {}
+        with self.lock:
+            self.check_pos_mode(symbol, params)
+            order_id = str(next(self.order_ids))
+            order = {
+                'id': order_id,
+                'clientOrderId': params.get('clOrdID') or params.get('clientOrderId'),
+                'symbol': symbol,
+                'type': type,
+                'side': side,
+                'amount': float(amount),
+                'price': price,
+                'stopPrice': params.get('stopPx'),
+                'reduceOnly': bool(params.get('reduceOnly')),
+                'posSide': params.get('posSide', 'Merged'),
+                'timestamp': int(time.time() * 1000),
+            }
+            self.orders[order_id] = order
+            return self.order_payload(order)
+
+    def edit_order(self, id, symbol, type, side, amount=None, price=None, params={}):
+        self.request('edit_order')
+        params = params or {}
+        with self.lock:
+            order = self.orders.get(id)
+            if order is None or order['symbol'] != symbol:
+                raise ccxt.OrderNotFound(f'phemex {{"code":10002,"msg":"OM_ORDER_NOT_FOUND"}} {id}')
+            self.check_pos_mode(symbol, params)
+            if amount is not None:
+                order['amount'] = float(amount)
+            if price is not None:
+                order['price'] = price
+            if params.get('stopPx') is not None:
+                order['stopPrice'] = params['stopPx']
+            return self.order_payload(order)
+
+    def cancel_order(self, id, symbol=None, params={}):
+        self.request('cancel_order')
+        with self.lock:
+            order = self.orders.get(id)
+            if order is None or (symbol is not None and order['symbol'] != symbol):
+                raise ccxt.OrderNotFound(f'phemex {{"code":10002,"msg":"OM_ORDER_NOT_FOUND"}} {id}')
+            self.check_pos_mode(order['symbol'], params)
+            del self.orders[id]
+            return {**self.order_payload(order), 'status': 'canceled'}
+
+    def cancel_orders(self, ids, symbol=None, params={}):
+        if not self.has['cancelOrders']:
+            raise ccxt.NotSupported('phemex cancelOrders() is not supported yet')
+        self.request('cancel_orders')
+        with self.lock:
+            cancelled = [self.orders.pop(id) for id in ids if id in self.orders]
+            return [{**self.order_payload(order), 'status': 'canceled'} for order in cancelled]
+
+    def private_delete_g_orders(self, params={}):
+        """phemex's raw bulk cancel: comma-separated orderIDs of one symbol and posSide, a bizError per order."""
+        self.request('private_delete_g_orders')
+        symbol = self.listed_by_id.get(params.get('symbol'))
+        if symbol is None:
+            raise ccxt.BadSymbol(f"phemex does not have market id {params.get('symbol')}")
+        with self.lock:
+            self.check_pos_mode(symbol, params)
+            data = []
+            for id in str(params.get('orderID', '')).split(','):
+                order = self.orders.get(id)
+                if order is None or order['symbol'] != symbol:
+                    data.append({'orderID': id, 'bizError': 10002})
+                    continue
+                del self.orders[id]
+                data.append({'orderID': id, 'bizError': 0, 'ordStatus': 'Canceled'})
+            return {'code': 0, 'msg': '', 'data': data}
+
+    def cancel_all_orders(self, symbol=None, params={}):
+        if symbol is None:
+            raise ccxt.ArgumentsRequired('phemex cancelAllOrders() requires a symbol argument')
+        self.request('cancel_all_orders')
+        self.market(symbol)
+        # Like phemex, conditional orders are only cancelled when asked for
+        trigger = bool((params or {}).get('trigger') or (params or {}).get('stop'))
+        with self.lock:
+            cancelled = [
+                order for order in self.orders.values()
+                if order['symbol'] == symbol and (order['type'] == 'stop') == trigger
+            ]
+            for order in cancelled:
+                del self.orders[order['id']]
+            return [{**self.order_payload(order), 'status': 'canceled'} for order in cancelled]
@@ -0,0 +1,50 @@
+"""Trailing-stop and re-entry rules as array operations.
+
+Shared by the live risk pass in main.py and the replay engine in
+backtest.py, so both make exactly the same decisions. Everything here works
+on NumPy arrays (or scalars) and never touches the exchange.
+"""
+import numpy as np
+
+# Trailing state a position starts with before its first stop move
+DEFAULT_THRESHOLD = 0.10
+DEFAULT_PROFIT_TARGET_DISTANCE = 0.06
+
+# Re-entry limit sits this fraction of the way from liquidation back to entry
+REENTRY_FROM_PERCENT = 0.1
+
+# Combined unrealized + realized PnL at or below this drops the trailing stop
+LOSING_PNL = 0.001
+
+
+def trailing_signals(is_long, entry, mark, contracts, leverage, realized_pnl, threshold, profit_target_distance):
+    """Evaluates the trailing-stop rule for every position at once.
+
+    Returns (profit_distance, unrealized_pnl, total_pnl, new_stop_price,
+    losing, move). losing marks positions whose trailing stop should be
+    dropped; move marks positions whose stop should go to new_stop_price.
+    """
+    direction = np.where(is_long, 1.0, -1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        profit_distance = direction * (mark - entry) / entry * leverage
+        unrealized_pnl = direction * (mark - entry) * contracts
+        total_pnl = unrealized_pnl + realized_pnl
+        new_stop_price = entry * (1 + direction * profit_target_distance / leverage)
+    losing = total_pnl <= LOSING_PNL
+    stop_valid = direction * (new_stop_price - entry) > 0
+    move = ~losing & (profit_distance >= threshold) & stop_valid
+    return profit_distance, unrealized_pnl, total_pnl, new_stop_price, losing, move
+
+
+def reentry_levels(entry, liquidation, mark, notional, from_percent=REENTRY_FROM_PERCENT):
+    """Re-entry limit price and size (double the current notional) for each position."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        price = liquidation + (entry - liquidation) * from_percent
+        amount = notional * 2 / mark
+    return price, amount
+
+
+def liquidation_closeness(entry, mark, liquidation):
+    """0 at the entry price, 1 at the liquidation price."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - np.abs(mark - liquidation) / np.abs(entry - liquidation)